@@ -0,0 +1,58 @@
+import time
+
+import main
+
+SCRIPTS = {
+    "while-counter": "i=0; while [ $i -lt 20000 ]; do i=$((i + 1)); done",
+    "for-list": "n=0; for x in " + " ".join(str(i) for i in range(20000)) + "; do n=$((n + x)); done",
+    "function-calls": "inc() { n=$((n + $1)); }; n=0; i=0; while [ $i -lt 5000 ]; do inc 2; i=$((i + 1)); done",
+    "nested-if": "i=0; while [ $i -lt 10000 ]; do if [ $((i % 3)) -eq 0 ]; then a=1; elif [ $((i % 3)) -eq 1 ]; then a=2; else a=3; fi; i=$((i + 1)); done",
+}
+
+def make_window(user="guest"):
+    win = main.TerminalWindow(0)
+    win.current_user = user
+    win.logged_in = True
+    return win
+
+def bench(name, src, runs=5):
+    win = make_window()
+    main.script_cache.clear()
+    t = time.perf_counter()
+    main.parse_script(src)
+    cold = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(runs):
+        main.parse_script(src)
+    cached = (time.perf_counter() - t) / runs
+    t = time.perf_counter()
+    for _ in range(runs):
+        main.handle_command(src, win)
+    run = (time.perf_counter() - t) / runs
+    print(f"{name:16} parse {cold*1000:8.2f}ms  cached {cached*1000:8.3f}ms  run {run*1000:9.2f}ms")
+
+def bench_permissions(dirs=500, files=200, runs=3):
+    # A warm sha256sum -r hashes nothing, so what is left is the tree walk
+    # and, for guest, a permission check on every node
+    tree = main.Directory("bench", "admin")
+    for i in range(dirs):
+        d = main.Directory(f"d{i}", "admin")
+        for j in range(files):
+            d.add(main.File(f"f{j}", f"{i}/{j}", "admin"))
+        tree.add(d)
+    main.root.add(tree)
+    timings = {}
+    for user in ("admin", "guest"):
+        win = make_window(user)
+        main.run_command(["sha256sum", "-r", "/bench"], win)
+        t = time.perf_counter()
+        for _ in range(runs):
+            main.run_command(["sha256sum", "-r", "/bench"], win)
+        timings[user] = (time.perf_counter() - t) / runs
+    main.root.remove("bench")
+    print(f"sha256sum -r over {dirs * files} cached files: admin {timings['admin']*1000:.0f}ms  guest {timings['guest']*1000:.0f}ms")
+
+if __name__ == "__main__":
+    for name, src in SCRIPTS.items():
+        bench(name, src)
+    bench_permissions()
@@ -5,64 +5,139 @@ import json
 import os
 import random
 import re
+import bisect
+import heapq
+import multiprocessing
+import stat
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Bumped whenever the live tree becomes shared with a snapshot; nodes from an
+# older epoch are frozen and must be copied before they are modified.
+fs_epoch = 0
+
+# Saves made before modes were octal hold the default modes as decimal
+# literals; chmod could only produce these values from modes like 1204
+LEGACY_MODES = {644: 0o644, 755: 0o755, 777: 0o777}
+
+def load_mode(data, default):
+    mode = data.get("mode", default)
+    return LEGACY_MODES.get(mode, mode)
+
+def valid_name(name):
+    # Entry names are single path components
+    return name not in ("", ".", "..") and "/" not in name
 
 class File:
-    def __init__(self, name, content="", owner="guest", mode=644):
+    def __init__(self, name, content="", owner="guest", mode=0o644):
         self.name = name
         self.content = content
-        self.size = len(content)
         self.owner = owner
         self.mode = mode
+        self.epoch = fs_epoch
+    @property
+    def content(self):
+        return self._content
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.size = len(value)
+        self.mtime = time.time()
+        self.digests = {}  # algorithm -> hex digest, dropped on every write
+    def clone(self):
+        f = File(self.name, self.content, self.owner, self.mode)
+        f.mtime = self.mtime
+        f.digests = dict(self.digests)
+        return f
     def to_dict(self):
-        return {"type": "file", "name": self.name, "content": self.content, "owner": self.owner, "mode": self.mode}
+        return {"type": "file", "name": self.name, "content": self.content, "owner": self.owner, "mode": self.mode, "mtime": self.mtime}
     @staticmethod
     def from_dict(data):
-        return File(data["name"], data.get("content", ""), data.get("owner", "guest"), data.get("mode", 644))
+        f = File(data["name"], data.get("content", ""), data.get("owner", "guest"), load_mode(data, 0o644))
+        f.mtime = data.get("mtime", f.mtime)
+        return f
 
 class Symlink:
-    def __init__(self, name, target, owner="guest", mode=777):
+    def __init__(self, name, target, owner="guest", mode=0o777):
         self.name = name
         self.target = target  # Path string
         self.owner = owner
         self.mode = mode
+        self.mtime = time.time()
+        self.epoch = fs_epoch
     def to_dict(self):
-        return {"type": "symlink", "name": self.name, "target": self.target, "owner": self.owner, "mode": self.mode}
+        return {"type": "symlink", "name": self.name, "target": self.target, "owner": self.owner, "mode": self.mode, "mtime": self.mtime}
     @staticmethod
     def from_dict(data):
-        return Symlink(data["name"], data["target"], data.get("owner", "guest"), data.get("mode", 777))
+        s = Symlink(data["name"], data["target"], data.get("owner", "guest"), load_mode(data, 0o777))
+        s.mtime = data.get("mtime", s.mtime)
+        return s
 
 class Hardlink:
-    def __init__(self, name, target_file, owner="guest", mode=644):
+    def __init__(self, name, target_file, owner="guest", mode=0o644):
         self.name = name
         self.target_file = target_file  # Reference to File object
         self.owner = owner
         self.mode = mode
+        self.epoch = fs_epoch
+    @property
+    def mtime(self):
+        return self.target_file.mtime
     def to_dict(self):
         return {"type": "hardlink", "name": self.name, "target": self.target_file.name, "owner": self.owner, "mode": self.mode}
     @staticmethod
     def from_dict(data, directory):
         # Find the file in the directory by name
         target = directory.get(data["target"])
-        return Hardlink(data["name"], target, data.get("owner", "guest"), data.get("mode", 644))
+        return Hardlink(data["name"], target, data.get("owner", "guest"), load_mode(data, 0o644))
 
 class Directory:
-    def __init__(self, name, owner="guest", mode=755, max_size=None):
+    def __init__(self, name, owner="guest", mode=0o755, max_size=None):
         self.name = name
         self.contents = {}
+        self.names = []  # sorted index of contents
+        self.pending = []  # names added since the index was last merged
         self.owner = owner
         self.mode = mode
         self.max_size = max_size  # in bytes, None means unlimited
+        self.mtime = time.time()
+        self.epoch = fs_epoch
+    def clone(self):
+        # Shallow copy: children stay shared until they are written themselves
+        d = Directory(self.name, self.owner, self.mode, self.max_size)
+        d.contents = dict(self.contents)
+        d.names = list(self.sorted_names())
+        d.mtime = self.mtime
+        return d
     def add(self, obj):
+        if obj.name not in self.contents:
+            # Appending is O(1); the next reader merges the batch in one sort
+            self.pending.append(obj.name)
         self.contents[obj.name] = obj
+        self.mtime = time.time()
+    def remove(self, name):
+        if self.contents.pop(name, None) is None:
+            return
+        if name in self.pending:
+            self.pending.remove(name)
+        else:
+            del self.names[bisect.bisect_left(self.names, name)]
+        self.mtime = time.time()
     def get(self, name):
         return self.contents.get(name)
+    def sorted_names(self):
+        if self.pending:
+            self.names.extend(self.pending)
+            self.names.sort()
+            self.pending = []
+        return self.names
     def list(self):
-        return list(self.contents.keys())
+        return list(self.sorted_names())
     def to_dict(self):
-        return {"type": "dir", "name": self.name, "contents": {k: v.to_dict() for k, v in self.contents.items()}, "owner": self.owner, "mode": self.mode, "max_size": self.max_size}
+        return {"type": "dir", "name": self.name, "contents": {k: v.to_dict() for k, v in self.contents.items()}, "owner": self.owner, "mode": self.mode, "max_size": self.max_size, "mtime": self.mtime}
     @staticmethod
     def from_dict(data):
-        d = Directory(data["name"], data.get("owner", "guest"), data.get("mode", 755), data.get("max_size"))
+        d = Directory(data["name"], data.get("owner", "guest"), load_mode(data, 0o755), data.get("max_size"))
         for k, v in data.get("contents", {}).items():
             if v["type"] == "file":
                 d.add(File.from_dict(v))
@@ -75,6 +150,7 @@ class Directory:
         for k, v in data.get("contents", {}).items():
             if v["type"] == "hardlink":
                 d.add(Hardlink.from_dict(v, d))
+        d.mtime = data.get("mtime", d.mtime)
         return d
     def get_size(self, seen=None):
         if seen is None:
@@ -114,6 +190,183 @@ def load_users():
             return json.load(f)
     return None
 
+IMPORT_WORKERS = 8
+IMPORT_BUFFER_BYTES = 64 * 1024 * 1024  # file bytes allowed in flight at once
+
+def read_host_file(path):
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", "surrogateescape")
+
+def write_host_file(path, content, mode):
+    with open(path, "wb") as f:
+        f.write(content.encode("utf-8", "surrogateescape"))
+    os.chmod(path, mode & 0o777)
+
+def import_tree(hostdir, target, owner, map_owners=False):
+    # Walks hostdir into the Directory target, reading file contents on a
+    # thread pool with at most IMPORT_BUFFER_BYTES outstanding. Entries belong
+    # to owner unless map_owners matches host uids against users
+    uid_owner = {u.get("uid"): name for name, u in users.items()} if map_owners else {}
+    stats = {"files": 0, "dirs": 0, "links": 0, "bytes": 0, "peak": 0, "errors": 0}
+    inodes = {}  # (st_dev, st_ino) -> (Directory, File) for multiply linked files
+    copies = []  # (File, File) pairs linked across directories
+    pending = deque()  # (future, File, size)
+    in_flight = 0
+    def drain(limit):
+        nonlocal in_flight
+        while pending and in_flight > limit:
+            fut, f, size = pending.popleft()
+            try:
+                f.content = fut.result()
+            except OSError:
+                stats["errors"] += 1
+            in_flight -= size
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        stack = [(hostdir, target)]
+        while stack:
+            path, d = stack.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                stats["errors"] += 1
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    stats["errors"] += 1
+                    continue
+                who = uid_owner.get(st.st_uid, owner)
+                mode = stat.S_IMODE(st.st_mode) & 0o777
+                if stat.S_ISLNK(st.st_mode):
+                    try:
+                        link_target = os.readlink(entry.path)
+                    except OSError:
+                        stats["errors"] += 1
+                        continue
+                    d.add(Symlink(entry.name, link_target, who, mode))
+                    stats["links"] += 1
+                elif stat.S_ISDIR(st.st_mode):
+                    sub = Directory(entry.name, who, mode)
+                    d.add(sub)
+                    stack.append((entry.path, sub))
+                    stats["dirs"] += 1
+                elif stat.S_ISREG(st.st_mode):
+                    key = (st.st_dev, st.st_ino)
+                    if st.st_nlink > 1 and key in inodes:
+                        first_dir, first = inodes[key]
+                        if first_dir is d:
+                            d.add(Hardlink(entry.name, first, who, mode))
+                        else:
+                            # Saved hardlinks resolve by name within one directory,
+                            # so other directories get a File sharing the content
+                            f = File(entry.name, "", who, mode)
+                            d.add(f)
+                            copies.append((first, f))
+                        stats["links"] += 1
+                        continue
+                    f = File(entry.name, "", who, mode)
+                    d.add(f)
+                    if st.st_nlink > 1:
+                        inodes[key] = (d, f)
+                    drain(max(IMPORT_BUFFER_BYTES - st.st_size, 0))
+                    pending.append((pool.submit(read_host_file, entry.path), f, st.st_size))
+                    in_flight += st.st_size
+                    stats["peak"] = max(stats["peak"], in_flight)
+                    stats["files"] += 1
+                    stats["bytes"] += st.st_size
+        drain(-1)
+    for first, f in copies:
+        f.content = first.content
+    return stats
+
+def export_tree(source, hostdir, allow=None):
+    # Writes the Directory source below hostdir; files sharing one File object
+    # (hardlinks) become host hardlinks. Entries allow() refuses count as errors
+    stats = {"files": 0, "dirs": 0, "links": 0, "bytes": 0, "peak": 0, "errors": 0}
+    written = {}  # id(File) -> host path
+    links = []  # (existing path, new path)
+    dir_modes = []
+    pending = deque()  # (future, size)
+    in_flight = 0
+    def drain(limit):
+        nonlocal in_flight
+        while pending and in_flight > limit:
+            fut, size = pending.popleft()
+            try:
+                fut.result()
+            except OSError:
+                stats["errors"] += 1
+            in_flight -= size
+    def clear(dest):
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.unlink(dest)
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        stack = [(source, hostdir)]
+        while stack:
+            d, path = stack.pop()
+            try:
+                os.makedirs(path, exist_ok=True)
+            except OSError:
+                stats["errors"] += 1
+                continue
+            dir_modes.append((path, d.mode))
+            for name, obj in d.contents.items():
+                if not valid_name(name):
+                    stats["errors"] += 1
+                    continue
+                dest = os.path.join(path, name)
+                try:
+                    target = obj.target_file if isinstance(obj, Hardlink) else obj
+                    if allow and not isinstance(obj, Symlink) and not allow(target, "rx" if isinstance(obj, Directory) else "r"):
+                        stats["errors"] += 1
+                    elif isinstance(obj, Directory):
+                        stack.append((obj, dest))
+                        stats["dirs"] += 1
+                    elif isinstance(obj, Symlink):
+                        clear(dest)
+                        os.symlink(obj.target, dest)
+                        stats["links"] += 1
+                    elif isinstance(obj, (File, Hardlink)):
+                        f = target
+                        if id(f) in written:
+                            links.append((written[id(f)], dest))
+                            continue
+                        written[id(f)] = dest
+                        clear(dest)
+                        drain(max(IMPORT_BUFFER_BYTES - f.size, 0))
+                        pending.append((pool.submit(write_host_file, dest, f.content, f.mode), f.size))
+                        in_flight += f.size
+                        stats["peak"] = max(stats["peak"], in_flight)
+                        stats["files"] += 1
+                        stats["bytes"] += f.size
+                except OSError:
+                    stats["errors"] += 1
+        drain(-1)
+    for src, dest in links:
+        try:
+            clear(dest)
+            os.link(src, dest)
+            stats["links"] += 1
+        except OSError:
+            stats["errors"] += 1
+    # Deepest directories first, so restrictive modes never block a write
+    for path, mode in reversed(dir_modes):
+        try:
+            os.chmod(path, mode & 0o777)
+        except OSError:
+            stats["errors"] += 1
+    return stats
+
+def transfer_report(verb, stats, seconds):
+    mb = stats["bytes"] / (1024 * 1024)
+    rate = mb / seconds if seconds > 0 else 0.0
+    lines = [f"{verb} {stats['files']} files, {stats['dirs']} directories, {stats['links']} links ({mb:.1f} MB) in {seconds:.2f}s",
+             f"Throughput {rate:.1f} MB/s, {stats['files'] / seconds if seconds > 0 else 0:.0f} files/s, peak buffered {stats['peak'] / (1024 * 1024):.1f} MB"]
+    if stats["errors"]:
+        lines.append(f"{stats['errors']} entries could not be transferred")
+    return lines
+
 users = {
     "guest": {"password": None, "home": "/home/guest", "uid": 1000},
     "admin": {"password": hashlib.sha256(b"admin123").hexdigest(), "home": "/home/admin", "uid": 0}
@@ -121,13 +374,13 @@ users = {
 
 root = load_filesystem()
 if not root:
-    root = Directory("/", max_size=1024*1024)  # 1MB
-    home = Directory("home", max_size=512*1024)  # 512KB
+    root = Directory("/", "admin", max_size=1024*1024)  # 1MB
+    home = Directory("home", "admin", max_size=512*1024)  # 512KB
     root.add(home)
     home.add(Directory("guest"))
-    home.add(Directory("admin"))
-    root.add(Directory("etc"))
-    root.add(Directory("var"))
+    home.add(Directory("admin", "admin"))
+    root.add(Directory("etc", "admin"))
+    root.add(Directory("var", "admin"))
 else:
     home = root.get("home")
 
@@ -221,9 +474,98 @@ class MountManager:
             return True
         return False
 
+HISTORY_FILE = "history.tos"
+HISTORY_MAX = 50000
+
+class HistoryStore:
+    # Per-user command history shared by all windows, persisted append-only
+    def __init__(self, path=HISTORY_FILE, max_entries=HISTORY_MAX):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}  # username -> list of commands, oldest first
+        self.index = {}  # username -> {trigram: ascending entry positions}
+        self.load()
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, "r") as f:
+            for line in f:
+                lines += 1
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self._insert(rec["user"], rec["cmd"])
+        # Compact the log once it holds far more than we keep
+        if lines > 2 * self.max_entries:
+            with open(self.path, "w") as f:
+                for user, entries in self.entries.items():
+                    for cmd in entries:
+                        f.write(json.dumps({"user": user, "cmd": cmd}) + "\n")
+    def get(self, user):
+        return self.entries.get(user, [])
+    def add(self, user, cmd):
+        self._insert(user, cmd)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"user": user, "cmd": cmd}) + "\n")
+    def _insert(self, user, cmd):
+        entries = self.entries.setdefault(user, [])
+        index = self.index.setdefault(user, {})
+        pos = len(entries)
+        entries.append(cmd)
+        for g in {cmd[i:i+3] for i in range(len(cmd) - 2)}:
+            index.setdefault(g, []).append(pos)
+        # Trim in chunks so the index is rebuilt rarely
+        if len(entries) > self.max_entries + self.max_entries // 10:
+            del entries[:len(entries) - self.max_entries]
+            self._reindex(user)
+    def _reindex(self, user):
+        index = self.index[user] = {}
+        for pos, cmd in enumerate(self.entries[user]):
+            for g in {cmd[i:i+3] for i in range(len(cmd) - 2)}:
+                index.setdefault(g, []).append(pos)
+    def search(self, user, query, before=None):
+        # Position of the newest entry before `before` containing query, or -1
+        entries = self.get(user)
+        if before is None or before > len(entries):
+            before = len(entries)
+        if len(query) < 3:
+            # Short queries match almost everything, so a backwards scan stops early
+            candidates = range(before - 1, -1, -1)
+        else:
+            index = self.index.get(user, {})
+            postings = min((index.get(query[i:i+3], []) for i in range(len(query) - 2)), key=len)
+            end = bisect.bisect_left(postings, before)
+            candidates = (postings[i] for i in range(end - 1, -1, -1))
+        for pos in candidates:
+            if query in entries[pos]:
+                return pos
+        return -1
+
+class SnapshotManager:
+    def __init__(self):
+        self.snapshots = {}  # name -> {"root": Directory, "time": float}
+    def create(self, name, tree):
+        global fs_epoch
+        if name in self.snapshots:
+            return False
+        # O(1): the snapshot shares every node with the live tree, which is
+        # frozen by moving to a new epoch
+        self.snapshots[name] = {"root": tree, "time": time.time()}
+        fs_epoch += 1
+        return True
+    def get(self, name):
+        snap = self.snapshots.get(name)
+        return snap["root"] if snap else None
+    def list(self):
+        return sorted(self.snapshots.items(), key=lambda kv: kv[1]["time"])
+
 procman = ProcessManager()
 pkgman = PackageManager()
 mountman = MountManager()
+history_store = HistoryStore()
+snapman = SnapshotManager()
 
 network_up = True
 ip_address = "192.168.1.100"
@@ -241,8 +583,13 @@ class TerminalWindow:
         self.temp_username = ""
         self.sudo_mode = False
         self.sudo_timestamp = 0
-        self.command_history = []
         self.history_index = -1
+        self.search_active = False
+        self.search_query = ""
+        self.search_pos = -1
+        self.env = {}
+        self.functions = {}
+        self.last_status = 0
         self.help_active = False
         self.help_scroll_offset = 0
 
@@ -264,6 +611,40 @@ def get_home_dir(username):
 def is_root(username):
     return users.get(username, {}).get("uid", 1000) == 0
 
+PERM_BITS = {"": 0, "r": 4, "w": 2, "x": 1, "rw": 6, "rx": 5, "wx": 3, "rwx": 7}
+
+def node_allows(user, obj, ops):
+    # A single mask test, which is cheaper than any memo of its result
+    need = PERM_BITS[ops]
+    return obj.mode >> (6 if obj.owner == user else 0) & need == need
+
+def is_privileged(win):
+    return win.sudo_mode or is_root(win.current_user)
+
+def can_access(win, names, ops):
+    # Search permission on every directory leading to names, then each of
+    # ops on the node itself; missing nodes are left to the caller to report
+    if is_privileged(win):
+        return True
+    user = win.current_user
+    obj = root
+    for n in names:
+        if not isinstance(obj, Directory):
+            return True
+        if not node_allows(user, obj, "x"):
+            return False
+        obj = obj.get(n)
+        if obj is None:
+            return True
+    return node_allows(user, obj, ops)
+
+def access_checker(win):
+    # Per-node check for recursive walkers, which reach nodes without names
+    if is_privileged(win):
+        return None
+    user = win.current_user
+    return lambda obj, ops: node_allows(user, obj, ops)
+
 def parse_symbolic_chmod(symbolic, current_mode):
     # Only supports u/g/o/a, +-=, and rwx
     mode = current_mode
@@ -302,6 +683,46 @@ def parse_symbolic_chmod(symbolic, current_mode):
                         mode |= {"r": 4, "w": 2, "x": 1}[p] << shift
     return mode
 
+HELP_LINES = [
+    "Available commands:",
+    "help",
+    "clear",
+    "exit",
+    "ls",
+    "cd",
+    "mkdir",
+    "touch",
+    "rm",
+    "cat",
+    "whoami",
+    "logout",
+    "save",
+    "load",
+    "ps",
+    "kill",
+    "top",
+    "pkg",
+    "ping",
+    "ifconfig",
+    "curl",
+    "mount",
+    "umount",
+    "chmod",
+    "chown",
+    "sudo",
+    "df",
+    "du",
+    "ln",
+    "history",
+    "snapshot",
+    "import",
+    "export  (export NAME=value sets a shell variable instead)",
+    "sha256sum",
+    "md5sum",
+    "fsck",
+    "(Ctrl-R: reverse history search)"
+]
+
 def main(stdscr):
     global root
     curses.curs_set(1)
@@ -314,39 +735,9 @@ def main(stdscr):
         stdscr.clear()
         win = windows[current_window]
         if win.help_active:
-            help_lines = [
-                "Available commands:",
-                "help",
-                "clear",
-                "exit",
-                "ls",
-                "cd",
-                "mkdir",
-                "touch",
-                "cat",
-                "whoami",
-                "logout",
-                "save",
-                "load",
-                "ps",
-                "kill",
-                "top",
-                "pkg",
-                "ping",
-                "ifconfig",
-                "curl",
-                "mount",
-                "umount",
-                "chmod",
-                "chown",
-                "sudo",
-                "df",
-                "du",
-                "ln"
-            ]
             start = win.help_scroll_offset
-            end = min(start + max_y - 3, len(help_lines))
-            for idx, line in enumerate(help_lines[start:end]):
+            end = min(start + max_y - 3, len(HELP_LINES))
+            for idx, line in enumerate(HELP_LINES[start:end]):
                 stdscr.addstr(idx+1, 2, line[:max_x-4])
             stdscr.addstr(max_y-2, 2, "(UP/DOWN to scroll, any key to exit help)")
             status = f"Win {current_window+1}/{len(windows)}"
@@ -355,7 +746,11 @@ def main(stdscr):
             return
         for idx, line in enumerate(win.buffer[-(max_y-3):]):
             stdscr.addstr(idx+1, 2, line[:max_x-4])
-        if win.logged_in:
+        if win.search_active:
+            entries = history_store.get(win.current_user)
+            match = entries[win.search_pos] if win.search_pos >= 0 else ""
+            stdscr.addstr(max_y-2, 2, f"(reverse-i-search)'{win.search_query}': {match}"[:max_x-4])
+        elif win.logged_in:
             stdscr.addstr(max_y-2, 2, (f"{get_path(win)}$ " + win.input_str)[:max_x-4])
         else:
             if win.login_state == "password":
@@ -370,10 +765,16 @@ def main(stdscr):
         return "/" + "/".join(d.name for d in win.path[1:])
 
     def autocomplete(fragment, win):
-        opts = list(win.cwd.contents.keys()) + [
-            "help", "clear", "exit", "ls", "cd", "mkdir", "touch", "cat", "whoami", "logout", "save", "load", "ps", "kill", "top", "pkg", "ping", "ifconfig", "curl", "mount", "umount", "chmod", "chown", "sudo"
-        ]
-        return [o for o in opts if o.startswith(fragment)]
+        # Entries sharing the prefix are one contiguous run of the sorted index
+        names = win.cwd.sorted_names()
+        i = bisect.bisect_left(names, fragment)
+        matches = []
+        while i < len(names) and names[i].startswith(fragment) and len(matches) < 100:
+            matches.append(names[i])
+            i += 1
+        return matches + [o for o in [
+            "help", "clear", "exit", "ls", "cd", "mkdir", "touch", "rm", "cat", "whoami", "logout", "save", "load", "ps", "kill", "top", "pkg", "ping", "ifconfig", "curl", "mount", "umount", "chmod", "chown", "sudo", "history", "snapshot", "import", "export", "sha256sum", "md5sum", "fsck"
+        ] if o.startswith(fragment)]
 
     draw()
     while running:
@@ -384,14 +785,42 @@ def main(stdscr):
                 if win.help_scroll_offset > 0:
                     win.help_scroll_offset -= 1
             elif key == curses.KEY_DOWN:
-                help_lines = 25  # number of help lines
-                if win.help_scroll_offset < help_lines - (max_y - 3):
+                if win.help_scroll_offset < len(HELP_LINES) - (max_y - 3):
                     win.help_scroll_offset += 1
             else:
                 win.help_active = False
                 win.help_scroll_offset = 0
             draw()
             continue
+        if win.search_active:
+            if key == 18:
+                # Ctrl-R again: step to the next older match
+                if win.search_pos >= 0:
+                    pos = history_store.search(win.current_user, win.search_query, win.search_pos)
+                    if pos >= 0:
+                        win.search_pos = pos
+            elif key in (curses.KEY_BACKSPACE, 127):
+                win.search_query = win.search_query[:-1]
+                win.search_pos = history_store.search(win.current_user, win.search_query)
+            elif key == 7:
+                # Ctrl-G: abort the search
+                win.search_active = False
+            elif 32 <= key <= 126:
+                # A longer query can only match at or before the current match
+                win.search_query += chr(key)
+                before = win.search_pos + 1 if win.search_pos >= 0 else None
+                win.search_pos = history_store.search(win.current_user, win.search_query, before)
+            else:
+                if win.search_pos >= 0:
+                    win.input_str = history_store.get(win.current_user)[win.search_pos]
+                win.search_active = False
+            draw()
+            continue
+        if key == 18:
+            if win.logged_in:
+                win.search_active = True
+                win.search_query = ""
+                win.search_pos = -1
         elif key in (curses.KEY_BACKSPACE, 127):
             win.input_str = win.input_str[:-1]
         elif key == 9:
@@ -401,18 +830,20 @@ def main(stdscr):
                 if comps:
                     win.input_str = " ".join(win.input_str.split()[:-1] + [comps[0]]) if win.input_str.split() else comps[0]
         elif key == curses.KEY_UP:
-            if win.logged_in and win.command_history:
+            command_history = history_store.get(win.current_user)
+            if win.logged_in and command_history:
                 if win.history_index == -1:
-                    win.history_index = len(win.command_history) - 1
+                    win.history_index = len(command_history) - 1
                 elif win.history_index > 0:
                     win.history_index -= 1
                 if win.history_index >= 0:
-                    win.input_str = win.command_history[win.history_index]
+                    win.input_str = command_history[win.history_index]
         elif key == curses.KEY_DOWN:
-            if win.logged_in and win.command_history and win.history_index != -1:
-                if win.history_index < len(win.command_history) - 1:
+            command_history = history_store.get(win.current_user)
+            if win.logged_in and command_history and win.history_index != -1:
+                if win.history_index < len(command_history) - 1:
                     win.history_index += 1
-                    win.input_str = win.command_history[win.history_index]
+                    win.input_str = command_history[win.history_index]
                 else:
                     win.history_index = -1
                     win.input_str = ""
@@ -444,9 +875,7 @@ def main(stdscr):
                 continue
             win.buffer.append(f"{get_path(win)}$ " + win.input_str)
             if win.input_str.strip():
-                win.command_history.append(win.input_str.strip())
-                if len(win.command_history) > 100:
-                    win.command_history = win.command_history[-100:]
+                history_store.add(win.current_user, win.input_str.strip())
             win.history_index = -1
             cmd = win.input_str.strip()
             parts = cmd.split()
@@ -455,21 +884,6 @@ def main(stdscr):
                 draw()
                 continue
             c = parts[0]
-            args = parts[1:]
-            if c == "sudo":
-                if not is_root(win.current_user) and win.current_user != "admin":
-                    win.buffer.append("sudo: user not in sudoers file")
-                elif not args:
-                    win.buffer.append("sudo: missing command")
-                else:
-                    win.sudo_mode = True
-                    sudo_cmd = " ".join(args)
-                    result = handle_command(sudo_cmd, win)
-                    win.sudo_mode = False
-                    win.buffer.extend(result)
-                win.input_str = ""
-                draw()
-                continue
             if c == "help":
                 win.help_active = True
                 win.help_scroll_offset = 0
@@ -519,47 +933,1035 @@ def resolve_obj(obj, cwd):
         return obj.target_file
     return obj
 
-def handle_command(cmd, win):
+def cwd_names(win):
+    return [d.name for d in win.path[1:]]
+
+def join_path(base, path):
+    # Absolute list of names for path, taken relative to the names in base
+    names = [] if path.startswith("/") else list(base)
+    for p in path.split("/"):
+        if p in ("", "."):
+            continue
+        if p == "..":
+            if names:
+                names.pop()
+        else:
+            names.append(p)
+    return names
+
+def split_path(win, path):
+    return join_path(cwd_names(win), path)
+
+def lookup(names):
+    obj = root
+    for n in names:
+        if not isinstance(obj, Directory):
+            return None
+        obj = obj.get(n)
+        if obj is None:
+            return None
+    return obj
+
+def follow_links(names):
+    # Path that names ends up at once symlinks are followed, or None for a
+    # loop; relative targets are taken from the link's own directory. The
+    # final path may not exist
+    seen = set()
+    while True:
+        obj = lookup(names)
+        if isinstance(obj, Symlink):
+            if tuple(names) in seen:
+                return None
+            seen.add(tuple(names))
+            names = join_path(names[:-1], obj.target)
+        elif isinstance(obj, Hardlink):
+            # Hardlinks always point at a file in their own directory
+            return names[:-1] + [obj.target_file.name]
+        else:
+            return names
+
+def locate(win, name):
+    # Like resolve_obj, but returns the path of the final object
+    names = follow_links(split_path(win, name))
+    return names if names is not None and lookup(names) is not None else None
+
+def rebind_windows():
+    # Re-walk every window's path after the tree was copied or replaced
+    for w in windows:
+        path = [root]
+        for d in w.path[1:]:
+            child = path[-1].get(d.name)
+            if not isinstance(child, Directory):
+                break
+            path.append(child)
+        w.path = path
+        w.cwd = path[-1]
+
+def writable_dir(names):
+    # Copy the frozen directories from the root down to names (path copying)
     global root, home
-    parts = cmd.strip().split()
+    if root.epoch != fs_epoch:
+        root = root.clone()
+    d = root
+    for n in names:
+        child = d.get(n)
+        if not isinstance(child, Directory):
+            return None
+        if child.epoch != fs_epoch:
+            child = child.clone()
+            d.contents[n] = child
+        d = child
+    home = root.get("home")
+    rebind_windows()
+    return d
+
+def writable_obj(names):
+    d = writable_dir(names[:-1])
+    if d is None or not names:
+        return d
+    obj = d.get(names[-1])
+    if isinstance(obj, Directory):
+        return writable_dir(names)
+    if isinstance(obj, File) and obj.epoch != fs_epoch:
+        new = obj.clone()
+        d.contents[names[-1]] = new
+        for k, v in d.contents.items():
+            if isinstance(v, Hardlink) and v.target_file is obj:
+                d.contents[k] = Hardlink(v.name, new, v.owner, v.mode)
+        obj = new
+    return obj
+
+def diff_trees(a, b, path="", allow=None):
+    # Only descends where the two trees stopped sharing nodes, and only into
+    # directories allow() lets the caller list in both trees
+    if a is b or (allow and not (allow(a, "rx") and allow(b, "rx"))):
+        return []
+    lines = []
+    if (a.owner, a.mode, a.max_size) != (b.owner, b.mode, b.max_size):
+        lines.append(f"M {path or '/'}")
+    changed = [name for name, y in b.contents.items() if a.contents.get(name) is not y]
+    changed += [name for name in a.contents if name not in b.contents]
+    for name in sorted(changed):
+        x, y = a.contents.get(name), b.contents.get(name)
+        p = f"{path}/{name}"
+        if x is None:
+            lines.append(f"A {p}")
+        elif y is None:
+            lines.append(f"D {p}")
+        elif isinstance(x, Directory) and isinstance(y, Directory):
+            lines += diff_trees(x, y, p, allow)
+        elif type(x) is not type(y) or x.to_dict() != y.to_dict():
+            lines.append(f"M {p}")
+    return lines
+
+SHELL_KEYWORDS = {"if", "then", "elif", "else", "fi", "while", "do", "done", "for", "in", "{", "}"}
+SHELL_OPS = ("&&", "||", ">>", ";", "\n", ">", "(", ")")
+SHELL_MAX_LOOPS = 1000000
+SHELL_MAX_DEPTH = 100
+SCRIPT_CACHE_SIZE = 256
+ASSIGN_RE = re.compile(r"^[A-Za-z_]\w*=")
+VAR_RE = re.compile(r"\$(?:\{(\w+)\}|(\w+|[?#@]))")
+ARITH_RE = re.compile(r"\s*(?:(\d+)|\$?\{?([A-Za-z_]\w*|\d)\}?|\$([?#])|(==|!=|<=|>=|&&|\|\||[-+*/%()<>!]))")
+ARITH_PREC = {"||": 1, "&&": 2, "==": 3, "!=": 3, "<": 4, ">": 4, "<=": 4, ">=": 4, "+": 5, "-": 5, "*": 6, "/": 6, "%": 6}
+
+script_cache = OrderedDict()  # sha256 of script source -> parsed tree, least recently used first
+arith_cache = {}  # arithmetic expression -> token list
+
+class ShellError(Exception):
+    pass
+
+class ShellFailure(Exception):
+    # A command failing at run time; reported, but the script carries on
+    def __init__(self, message, status=1):
+        super().__init__(message)
+        self.status = status
+
+class ShellBreak(Exception):
+    pass
+
+class ShellContinue(Exception):
+    pass
+
+class ShellReturn(Exception):
+    def __init__(self, status):
+        self.status = status
+
+def arith_end(src, i):
+    # Index of the "))" closing a $(( started just before i
+    depth = 0
+    while i < len(src):
+        if src[i] == "(":
+            depth += 1
+        elif src[i] == ")":
+            if depth == 0 and src.startswith("))", i):
+                return i
+            depth -= 1
+        i += 1
+    raise ShellError("unterminated $((")
+
+def tokenize(src):
+    # Tokens are ("op", text) or ("word", [(kind, text), ...]) where kind is
+    # "lit" (no expansion), "dq" (expand, no splitting) or "uq" (expand and split)
+    tokens = []
+    i, n = 0, len(src)
+    while i < n:
+        ch = src[i]
+        if ch in " \t\r":
+            i += 1
+            continue
+        if ch == "#":
+            while i < n and src[i] != "\n":
+                i += 1
+            continue
+        op = next((o for o in SHELL_OPS if src.startswith(o, i)), None) if ch in ";\n&|>()" else None
+        if op:
+            tokens.append(("op", op))
+            i += len(op)
+            continue
+        if ch in "&|<":
+            raise ShellError(f"unsupported operator '{ch}'")
+        segments = []
+        buf = ""
+        while i < n and src[i] not in " \t\r\n;&|<>()":
+            ch = src[i]
+            if ch == "'":
+                j = src.find("'", i + 1)
+                if j < 0:
+                    raise ShellError("unterminated quote")
+                if buf:
+                    segments.append(("uq", buf))
+                    buf = ""
+                segments.append(("lit", src[i+1:j]))
+                i = j + 1
+            elif ch == '"':
+                if buf:
+                    segments.append(("uq", buf))
+                    buf = ""
+                j = i + 1
+                text = ""
+                while j < n and src[j] != '"':
+                    if src[j] == "\\" and j + 1 < n and src[j+1] == "$":
+                        # An escaped dollar becomes its own literal segment
+                        if text:
+                            segments.append(("dq", text))
+                            text = ""
+                        segments.append(("lit", "$"))
+                        j += 2
+                    elif src[j] == "\\" and j + 1 < n and src[j+1] in '"\\':
+                        text += src[j+1]
+                        j += 2
+                    else:
+                        text += src[j]
+                        j += 1
+                if j >= n:
+                    raise ShellError("unterminated quote")
+                segments.append(("dq", text))
+                i = j + 1
+            elif ch == "\\" and i + 1 < n:
+                if buf:
+                    segments.append(("uq", buf))
+                    buf = ""
+                segments.append(("lit", src[i+1]))
+                i += 2
+            elif src.startswith("$((", i):
+                j = arith_end(src, i + 3)
+                buf += src[i:j+2]
+                i = j + 2
+            else:
+                buf += ch
+                i += 1
+        if buf:
+            segments.append(("uq", buf))
+        tokens.append(("word", segments))
+    return tokens
+
+def word_text(tok):
+    # Plain text of an unquoted word, used to recognise keywords
+    if tok and tok[0] == "word" and len(tok[1]) == 1 and tok[1][0][0] == "uq":
+        return tok[1][0][1]
+    return None
+
+class ShellParser:
+    # Nodes are tuples: ("list", nodes), ("and"/"or", left, right),
+    # ("cmd", words, redirects), ("if", [(cond, body)], else_body),
+    # ("while", cond, body), ("for", name, words, body), ("func", name, body)
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+    def next(self):
+        tok = self.peek()
+        self.pos += 1
+        return tok
+    def at_op(self, *ops):
+        tok = self.peek()
+        return tok is not None and tok[0] == "op" and tok[1] in ops
+    def at_word(self, *words):
+        return word_text(self.peek()) in words
+    def expect_word(self, word):
+        if not self.at_word(word):
+            tok = self.peek()
+            found = "end of input" if tok is None else (word_text(tok) or tok[1])
+            raise ShellError(f"syntax error: expected '{word}' near {found!r}")
+        self.pos += 1
+    def skip_separators(self):
+        while self.at_op(";", "\n"):
+            self.pos += 1
+    def parse(self):
+        tree = self.parse_list()
+        if self.peek() is not None:
+            tok = self.peek()
+            raise ShellError(f"syntax error near {(word_text(tok) or tok[1])!r}")
+        return tree
+    def parse_list(self):
+        nodes = []
+        self.skip_separators()
+        while self.peek() is not None and not self.at_op(")") and not self.at_word("then", "elif", "else", "fi", "do", "done", "}"):
+            nodes.append(self.parse_and_or())
+            self.skip_separators()
+        return ("list", nodes)
+    def parse_and_or(self):
+        node = self.parse_command()
+        while self.at_op("&&", "||"):
+            kind = "and" if self.next()[1] == "&&" else "or"
+            self.skip_separators()
+            node = (kind, node, self.parse_command())
+        return node
+    def parse_command(self):
+        kw = word_text(self.peek())
+        if kw == "if":
+            self.pos += 1
+            branches = []
+            cond = self.parse_list()
+            self.expect_word("then")
+            branches.append((cond, self.parse_list()))
+            else_body = None
+            while self.at_word("elif"):
+                self.pos += 1
+                cond = self.parse_list()
+                self.expect_word("then")
+                branches.append((cond, self.parse_list()))
+            if self.at_word("else"):
+                self.pos += 1
+                else_body = self.parse_list()
+            self.expect_word("fi")
+            return ("if", branches, else_body)
+        if kw == "while":
+            self.pos += 1
+            cond = self.parse_list()
+            self.expect_word("do")
+            body = self.parse_list()
+            self.expect_word("done")
+            return ("while", cond, body)
+        if kw == "for":
+            self.pos += 1
+            name = word_text(self.next())
+            if not name or not re.match(r"^[A-Za-z_]\w*$", name):
+                raise ShellError("syntax error: bad for loop variable")
+            words = None
+            self.skip_separators()
+            if self.at_word("in"):
+                self.pos += 1
+                words = []
+                while self.peek() is not None and self.peek()[0] == "word":
+                    words.append(self.next()[1])
+            self.skip_separators()
+            self.expect_word("do")
+            body = self.parse_list()
+            self.expect_word("done")
+            return ("for", name, words, body)
+        if kw == "{":
+            self.pos += 1
+            body = self.parse_list()
+            self.expect_word("}")
+            return body
+        if kw in SHELL_KEYWORDS:
+            raise ShellError(f"syntax error near {kw!r}")
+        tok = self.peek()
+        if tok is not None and tok[0] == "word" and kw and self.pos + 2 < len(self.tokens) \
+                and self.tokens[self.pos+1] == ("op", "(") and self.tokens[self.pos+2] == ("op", ")"):
+            self.pos += 3
+            self.skip_separators()
+            return ("func", kw, self.parse_command())
+        return self.parse_simple()
+    def parse_simple(self):
+        words = []
+        redirects = []
+        while True:
+            tok = self.peek()
+            if tok is None:
+                break
+            if tok[0] == "word":
+                words.append(self.next()[1])
+            elif tok[1] in (">", ">>"):
+                self.pos += 1
+                target = self.next()
+                if target is None or target[0] != "word":
+                    raise ShellError("syntax error: missing redirection target")
+                redirects.append((tok[1], target[1]))
+            else:
+                break
+        if not words and not redirects:
+            tok = self.peek()
+            raise ShellError(f"syntax error near {'end of input' if tok is None else tok[1]!r}")
+        return ("cmd", words, redirects)
+
+def parse_script(src, key=None):
+    # Parsed trees are cached by content hash, so an edited script re-parses
+    # and an unchanged one never does
+    if key is None:
+        key = hashlib.sha256(src.encode("utf-8", "surrogateescape")).hexdigest()
+    tree = script_cache.get(key)
+    if tree is not None:
+        script_cache.move_to_end(key)
+        return tree
+    tree = ShellParser(tokenize(src)).parse()
+    if len(script_cache) >= SCRIPT_CACHE_SIZE:
+        script_cache.popitem(last=False)
+    script_cache[key] = tree
+    return tree
+
+class ShellContext:
+    def __init__(self, win, args=None):
+        self.win = win
+        self.args = args or []
+        self.output = []
+        self.depth = 0
+        self.redirected = 0  # nesting depth of commands whose output is captured
+    def var(self, name):
+        if name == "?":
+            return str(self.win.last_status)
+        if name == "#":
+            return str(len(self.args))
+        if name == "@":
+            return " ".join(self.args)
+        if name.isdigit():
+            n = int(name)
+            if n == 0:
+                return "sh"
+            return self.args[n-1] if n <= len(self.args) else ""
+        if name in self.win.env:
+            return self.win.env[name]
+        if name == "USER":
+            return self.win.current_user or ""
+        if name == "HOME":
+            u = users.get(self.win.current_user)
+            return u["home"] if u else "/"
+        if name == "PWD":
+            return "/" + "/".join(cwd_names(self.win))
+        return ""
+
+def eval_arith(expr, ctx):
+    tokens = arith_cache.get(expr)
+    if tokens is None:
+        tokens = []
+        pos = 0
+        expr_end = len(expr.rstrip())
+        while pos < expr_end:
+            m = ARITH_RE.match(expr, pos)
+            if not m or m.end() == pos:
+                raise ShellError(f"arithmetic syntax error: {expr.strip()}")
+            num, name, special, op = m.groups()
+            if num is not None:
+                tokens.append(("num", int(num)))
+            elif name is not None or special is not None:
+                tokens.append(("var", name or special))
+            else:
+                tokens.append(("op", op))
+            pos = m.end()
+        arith_cache[expr] = tokens
+    pos = 0
+    def atom():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ShellError(f"arithmetic syntax error: {expr.strip()}")
+        kind, val = tokens[pos]
+        pos += 1
+        if kind == "num":
+            return val
+        if kind == "var":
+            text = ctx.var(val) or "0"
+            try:
+                return int(text)
+            except ValueError:
+                raise ShellError(f"arithmetic: {val}: not a number")
+        if val == "(":
+            v = binary(0)
+            if pos >= len(tokens) or tokens[pos] != ("op", ")"):
+                raise ShellError(f"arithmetic syntax error: {expr.strip()}")
+            pos += 1
+            return v
+        if val == "-":
+            return -atom()
+        if val == "+":
+            return atom()
+        if val == "!":
+            return int(not atom())
+        raise ShellError(f"arithmetic syntax error: {expr.strip()}")
+    def binary(min_prec):
+        nonlocal pos
+        left = atom()
+        while pos < len(tokens) and tokens[pos][0] == "op" and ARITH_PREC.get(tokens[pos][1], 0) > min_prec:
+            op = tokens[pos][1]
+            pos += 1
+            right = binary(ARITH_PREC[op])
+            if op in ("/", "%"):
+                if right == 0:
+                    raise ShellError("arithmetic: division by zero")
+                q = abs(left) // abs(right) * (1 if (left < 0) == (right < 0) else -1)
+                left = q if op == "/" else left - q * right
+            elif op == "+":
+                left += right
+            elif op == "-":
+                left -= right
+            elif op == "*":
+                left *= right
+            elif op == "&&":
+                left = int(bool(left and right))
+            elif op == "||":
+                left = int(bool(left or right))
+            else:
+                left = int({"==": left == right, "!=": left != right, "<": left < right,
+                            ">": left > right, "<=": left <= right, ">=": left >= right}[op])
+        return left
+    value = binary(0)
+    if pos != len(tokens):
+        raise ShellError(f"arithmetic syntax error: {expr.strip()}")
+    return value
+
+def expand_text(text, ctx):
+    out = []
+    i = 0
+    while True:
+        j = text.find("$", i)
+        if j < 0:
+            out.append(text[i:])
+            break
+        out.append(text[i:j])
+        if text.startswith("$((", j):
+            k = arith_end(text, j + 3)
+            out.append(str(eval_arith(text[j+3:k], ctx)))
+            i = k + 2
+            continue
+        m = VAR_RE.match(text, j)
+        if m:
+            out.append(ctx.var(m.group(1) or m.group(2)))
+            i = m.end()
+        else:
+            out.append("$")
+            i = j + 1
+    return "".join(out)
+
+def expand_word(word, ctx, split=True):
+    fields = [["", False]]  # text, whether it must survive even when empty
+    for kind, text in word:
+        if kind == "lit":
+            fields[-1][0] += text
+            fields[-1][1] = True
+        elif kind == "dq":
+            fields[-1][0] += expand_text(text, ctx) if "$" in text else text
+            fields[-1][1] = True
+        elif "$" not in text:
+            fields[-1][0] += text
+            fields[-1][1] = True
+        else:
+            pieces = re.split(r"\s+", expand_text(text, ctx)) if split else [expand_text(text, ctx)]
+            fields[-1][0] += pieces[0]
+            fields.extend([p, False] for p in pieces[1:])
+    return [text for text, keep in fields if text or keep]
+
+def expand_words(words, ctx):
+    argv = []
+    for w in words:
+        if len(w) == 1 and (w[0][0] == "lit" or "$" not in w[0][1]):
+            # Nothing to expand or split
+            argv.append(w[0][1])
+        else:
+            argv.extend(expand_word(w, ctx))
+    return argv
+
+def shell_test(argv, ctx):
+    if argv and argv[0] == "!":
+        return 1 - shell_test(argv[1:], ctx)
+    if not argv:
+        return 1
+    if len(argv) == 1:
+        return 0 if argv[0] else 1
+    if len(argv) == 2:
+        op, val = argv
+        if op == "-n":
+            return 0 if val else 1
+        if op == "-z":
+            return 0 if not val else 1
+        if op in ("-e", "-f", "-d"):
+            # Paths behind a directory the user cannot search do not exist
+            loc = locate(ctx.win, val)
+            if loc is None or not (can_access(ctx.win, split_path(ctx.win, val), "") and can_access(ctx.win, loc, "")):
+                return 1
+            obj = lookup(loc)
+            if op == "-f":
+                return 0 if isinstance(obj, File) else 1
+            if op == "-d":
+                return 0 if isinstance(obj, Directory) else 1
+            return 0 if obj is not None else 1
+    if len(argv) == 3:
+        a, op, b = argv
+        if op in ("=", "=="):
+            return 0 if a == b else 1
+        if op == "!=":
+            return 0 if a != b else 1
+        ints = {"-eq": int.__eq__, "-ne": int.__ne__, "-lt": int.__lt__, "-le": int.__le__, "-gt": int.__gt__, "-ge": int.__ge__}
+        if op in ints:
+            try:
+                return 0 if ints[op](int(a), int(b)) else 1
+            except ValueError:
+                raise ShellFailure("test: integer expression expected", 2)
+    raise ShellFailure(f"test: unknown expression: {' '.join(argv)}", 2)
+
+def write_redirect(op, target, lines, ctx):
+    win = ctx.win
+    text = "".join(line + "\n" for line in lines)
+    names = locate(win, target) or split_path(win, target)
+    if not names:
+        raise ShellFailure(f"{target}: Is a directory")
+    if not isinstance(lookup(names[:-1]), Directory):
+        raise ShellFailure(f"{target}: No such file or directory")
+    obj = lookup(names)
+    if not can_access(win, names if obj is not None else names[:-1], "w" if obj is not None else "wx"):
+        raise ShellFailure(f"{target}: Permission denied")
+    parent = writable_dir(names[:-1])
+    if obj is None:
+        parent.add(File(names[-1], text, win.current_user if win.current_user else "guest"))
+        return
+    if not isinstance(obj, File):
+        raise ShellFailure(f"{target}: Not a file")
+    f = writable_obj(names)
+    f.content = f.content + text if op == ">>" else text
+
+def run_source(argv, ctx):
+    win = ctx.win
+    if len(argv) < 2:
+        raise ShellFailure(f"{argv[0]}: filename argument required")
+    loc = locate(win, argv[1])
+    obj = lookup(loc) if loc is not None else None
+    if not isinstance(obj, File):
+        raise ShellFailure(f"{argv[0]}: {argv[1]}: No such file")
+    if not can_access(win, loc, "r"):
+        raise ShellFailure(f"{argv[0]}: {argv[1]}: Permission denied")
+    try:
+        tree = parse_script(obj.content, file_digest(obj))
+    except ShellError as e:
+        raise ShellFailure(f"{argv[1]}: {e}", 2)
+    saved = ctx.args
+    ctx.args = argv[2:]
+    try:
+        return exec_node(tree, ctx)
+    except ShellReturn as r:
+        return r.status
+    finally:
+        ctx.args = saved
+
+def exec_simple(node, ctx):
+    win = ctx.win
+    words = node[1]
+    while words and words[0] and words[0][0][0] == "uq" and ASSIGN_RE.match(words[0][0][1]):
+        first = words[0][0][1]
+        name, _, rest = first.partition("=")
+        value = ([("uq", rest)] if rest else []) + words[0][1:]
+        win.env[name] = "".join(expand_word(value, ctx, split=False))
+        words = words[1:]
+    argv = expand_words(words, ctx)
+    try:
+        if not node[2]:
+            return exec_argv(argv, ctx) if argv else 0
+        saved = ctx.output
+        ctx.output = []
+        ctx.redirected += 1
+        try:
+            status = exec_argv(argv, ctx) if argv else 0
+        finally:
+            captured = ctx.output
+            ctx.output = saved
+            ctx.redirected -= 1
+        for op, target in node[2]:
+            names = expand_word(target, ctx, split=False)
+            write_redirect(op, names[0] if names else "", captured, ctx)
+            # Only the first target gets the output, like sh truncating the rest
+            captured = []
+        return status
+    except ShellFailure as e:
+        ctx.output.append(f"sh: {e}")
+        return e.status
+
+def exec_argv(argv, ctx):
+    win = ctx.win
+    c = argv[0]
+    if c in win.functions:
+        if ctx.depth >= SHELL_MAX_DEPTH:
+            raise ShellError(f"{c}: maximum function nesting depth exceeded")
+        saved = ctx.args
+        ctx.args = argv[1:]
+        ctx.depth += 1
+        try:
+            return exec_node(win.functions[c], ctx)
+        except ShellReturn as r:
+            return r.status
+        finally:
+            ctx.args = saved
+            ctx.depth -= 1
+    if c == "echo":
+        ctx.output.append(" ".join(argv[1:]))
+        return 0
+    if c == "true":
+        return 0
+    if c == "false":
+        return 1
+    if c == "test":
+        return shell_test(argv[1:], ctx)
+    if c == "[":
+        if argv[-1] != "]":
+            raise ShellFailure("[: missing ']'", 2)
+        return shell_test(argv[1:-1], ctx)
+    if c in ("source", "."):
+        return run_source(argv, ctx)
+    if c == "sudo":
+        # Goes back through this dispatcher so builtins and functions work too
+        if not is_root(win.current_user) and win.current_user != "admin":
+            ctx.output.append("sudo: user not in sudoers file")
+            return 1
+        if len(argv) < 2:
+            ctx.output.append("sudo: missing command")
+            return 1
+        saved = win.sudo_mode
+        win.sudo_mode = True
+        try:
+            return exec_argv(argv[1:], ctx)
+        finally:
+            win.sudo_mode = saved
+    if c == "break":
+        raise ShellBreak()
+    if c == "continue":
+        raise ShellContinue()
+    if c == "return":
+        raise ShellReturn(int(argv[1]) if len(argv) > 1 and argv[1].isdigit() else win.last_status)
+    # export NAME=value sets a variable; anything else is the VFS export
+    if c == "unset" or (c == "export" and len(argv) > 1 and all("=" in a for a in argv[1:])):
+        for a in argv[1:]:
+            name, eq, value = a.partition("=")
+            if c == "unset":
+                win.env.pop(name, None)
+            elif eq:
+                win.env[name] = value
+        return 0
+    output = run_command(argv, win)
+    ctx.output.extend(output)
+    if not ctx.redirected:
+        ctx.output.extend(getattr(output, "footer", ()))
+    return getattr(output, "status", 0)
+
+def exec_node(node, ctx):
+    win = ctx.win
+    kind = node[0]
+    if kind == "list":
+        status = 0
+        for child in node[1]:
+            status = exec_node(child, ctx)
+    elif kind == "cmd":
+        status = exec_simple(node, ctx)
+    elif kind == "and":
+        status = exec_node(node[1], ctx)
+        if status == 0:
+            status = exec_node(node[2], ctx)
+    elif kind == "or":
+        status = exec_node(node[1], ctx)
+        if status != 0:
+            status = exec_node(node[2], ctx)
+    elif kind == "if":
+        status = 0
+        for cond, body in node[1]:
+            if exec_node(cond, ctx) == 0:
+                status = exec_node(body, ctx)
+                break
+        else:
+            if node[2] is not None:
+                status = exec_node(node[2], ctx)
+    elif kind in ("while", "for"):
+        status = 0
+        if kind == "while":
+            items = None
+        elif node[2] is None:
+            items = list(ctx.args)
+        else:
+            items = expand_words(node[2], ctx)
+        count = 0
+        while True:
+            if items is None:
+                if exec_node(node[1], ctx) != 0:
+                    break
+            elif count >= len(items):
+                break
+            else:
+                win.env[node[1]] = items[count]
+            count += 1
+            if count > SHELL_MAX_LOOPS:
+                raise ShellError(f"loop limit of {SHELL_MAX_LOOPS} iterations exceeded")
+            try:
+                status = exec_node(node[2] if kind == "while" else node[3], ctx)
+            except ShellBreak:
+                break
+            except ShellContinue:
+                continue
+    elif kind == "func":
+        win.functions[node[1]] = node[2]
+        status = 0
+    win.last_status = status
+    return status
+
+HASH_PARALLEL_BYTES = 8 * 1024 * 1024  # below this, hashing stays in process
+HASH_BATCH_BYTES = 4 * 1024 * 1024
+HASH_CAN_FORK = "fork" in multiprocessing.get_all_start_methods()
+
+hash_pool = None  # created on first large job and reused for the session
+
+def hash_batch(algo, contents):
+    return [hashlib.new(algo, c.encode("utf-8", "surrogateescape")).hexdigest() for c in contents]
+
+def hash_files(files, algo):
+    # Fills in missing cached digests, fanning large jobs out to a process
+    # pool in batches; returns how many files actually had to be hashed
+    global hash_pool
+    todo = list({id(f): f for f in files if algo not in f.digests}.values())
+    if sum(f.size for f in todo) < HASH_PARALLEL_BYTES or not HASH_CAN_FORK:
+        for f, digest in zip(todo, hash_batch(algo, [f.content for f in todo])):
+            f.digests[algo] = digest
+        return len(todo)
+    batches = [[]]
+    batch_bytes = 0
+    for f in todo:
+        if batch_bytes >= HASH_BATCH_BYTES:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(f)
+        batch_bytes += f.size
+    if hash_pool is None:
+        # Forked workers never re-import this module, which would reload the
+        # filesystem and race the history compaction under spawn
+        hash_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork"))
+    results = hash_pool.map(hash_batch, [algo] * len(batches), [[f.content for f in b] for b in batches])
+    for batch, digests in zip(batches, results):
+        for f, digest in zip(batch, digests):
+            f.digests[algo] = digest
+    return len(todo)
+
+def file_digest(f, algo="sha256"):
+    if algo not in f.digests:
+        hash_files([f], algo)
+    return f.digests[algo]
+
+def collect_files(d, path, found, allow=None):
+    # (display path, File) for every regular file below d, or (display path,
+    # error) for entries allow() refuses; symlinks are skipped
+    for name in d.sorted_names():
+        obj = d.contents[name]
+        p = path + name if path.endswith("/") else f"{path}/{name}"
+        if isinstance(obj, Hardlink):
+            obj = obj.target_file
+        if isinstance(obj, Directory):
+            if allow and not allow(obj, "rx"):
+                found.append((p, "Permission denied"))
+            else:
+                collect_files(obj, p, found, allow)
+        elif isinstance(obj, File):
+            found.append((p, obj) if not allow or allow(obj, "r") else (p, "Permission denied"))
+    return found
+
+def fsck_tree(d, names, problems):
+    # Returns the number of entries checked; problems are appended as lines
+    checked = 1
+    path = "".join("/" + n for n in names)
+    if d.owner not in users:
+        problems.append(f"{path or '/'}: unknown owner '{d.owner}'")
+    if d.max_size is not None:
+        used = d.get_size()
+        if used > d.max_size:
+            problems.append(f"{path or '/'}: {used} bytes used exceeds quota of {d.max_size}")
+    for name, obj in d.contents.items():
+        p = f"{path}/{name}"
+        if isinstance(obj, Directory):
+            checked += fsck_tree(obj, names + [name], problems)
+            continue
+        checked += 1
+        if obj.owner not in users:
+            problems.append(f"{p}: unknown owner '{obj.owner}'")
+        if isinstance(obj, Hardlink):
+            t = obj.target_file
+            if not isinstance(t, File):
+                problems.append(f"{p}: hardlink has no target file")
+            elif d.contents.get(t.name) is not t:
+                problems.append(f"{p}: hardlink target '{t.name}' is missing from its directory")
+        elif isinstance(obj, Symlink):
+            target = follow_links(names + [name])
+            if target is None:
+                problems.append(f"{p}: symlink loop -> {obj.target}")
+            elif lookup(target) is None:
+                problems.append(f"{p}: dangling symlink -> {obj.target}")
+    return checked
+
+LS_PAGE_SIZE = 100
+RWX = ["---", "--x", "-w-", "-wx", "r--", "r-x", "rw-", "rwx"]
+
+def perm_string(obj):
+    if isinstance(obj, Directory):
+        t = 'd'
+    elif isinstance(obj, Symlink):
+        t = 'l'
+    elif isinstance(obj, Hardlink):
+        t = 'h'
+    else:
+        t = '-'
+    m = obj.mode
+    return t + RWX[m >> 6 & 7] + RWX[m >> 3 & 7] + RWX[m & 7]
+
+def entry_size(obj):
+    if isinstance(obj, File):
+        return obj.size
+    if isinstance(obj, Hardlink):
+        return obj.target_file.size
+    if isinstance(obj, Symlink):
+        return len(obj.target)
+    return 4096
+
+def format_entry(name, obj, long):
+    if not long:
+        return name
+    line = f"{perm_string(obj)} {obj.owner:8} {entry_size(obj):>8} {time.strftime('%b %d %H:%M', time.localtime(obj.mtime))} {name}"
+    if isinstance(obj, Symlink):
+        line += f" -> {obj.target}"
+    return line
+
+def list_directory(d, flags, page=None, parent=None):
+    # Formats only the requested page, or everything without one; returns
+    # the lines and a page footer. parent is shown as "..", the root being
+    # its own parent
+    names = d.sorted_names()
+    if "a" in flags:
+        visible = names
+        count = len(names)
+    else:
+        # Dotfiles are one contiguous run of the sorted index
+        lo = bisect.bisect_left(names, ".")
+        hi = bisect.bisect_left(names, "/")
+        visible = None
+        count = len(names) - (hi - lo)
+    if page is None:
+        start, end = 0, count
+    else:
+        start, end = (page - 1) * LS_PAGE_SIZE, min(page * LS_PAGE_SIZE, count)
+    if "S" in flags or "t" in flags:
+        # Only the first `end` entries are ever ordered, O(n log end)
+        show_all = "a" in flags
+        if "S" in flags:
+            keyed = ((-entry_size(o), n) for n, o in d.contents.items() if show_all or n[:1] != ".")
+        else:
+            keyed = ((-o.mtime, n) for n, o in d.contents.items() if show_all or n[:1] != ".")
+        selected = [n for _, n in heapq.nsmallest(end, keyed)[start:end]]
+    elif visible is not None:
+        selected = visible[start:end]
+    else:
+        # Map the visible slice around the skipped dotfile run
+        gap = hi - lo
+        selected = names[start:min(end, lo)] + names[max(start, lo) + gap:end + gap]
+    lines = []
+    if "a" in flags and start == 0:
+        lines += [format_entry(".", d, "l" in flags), format_entry("..", parent or d, "l" in flags)]
+    lines += [format_entry(n, d.contents[n], "l" in flags) for n in selected]
+    if not lines:
+        lines.append("")
+    if page is None:
+        return lines, None
+    pages = max((count + LS_PAGE_SIZE - 1) // LS_PAGE_SIZE, 1)
+    return lines, f"-- page {page}/{pages} ({count} entries), ls --page N for more --"
+
+def handle_command(cmd, win):
+    ctx = ShellContext(win)
+    try:
+        exec_node(parse_script(cmd), ctx)
+    except ShellError as e:
+        ctx.output.append(f"sh: {e}")
+        win.last_status = 2
+    except (ShellBreak, ShellContinue, ShellReturn):
+        pass
+    except RecursionError:
+        ctx.output.append("sh: maximum nesting depth exceeded")
+        win.last_status = 2
+    return ctx.output
+
+class CommandOutput(list):
+    # Output lines of one command together with its exit status; footer
+    # lines are for the terminal only and never go into a redirect
+    def __init__(self, lines=(), status=0):
+        super().__init__(lines)
+        self.status = status
+        self.footer = []
+    def fail(self, line, status=1):
+        self.append(line)
+        self.status = status
+
+def run_command(parts, win):
+    global root, home, fs_epoch
     if not parts:
         return []
+    cmd = " ".join(parts)
     c = parts[0]
     args = parts[1:]
-    output = []
+    output = CommandOutput()
     if c == "help":
-        output.append("Available: help, clear, exit, ls, cd, mkdir, touch, cat, whoami, logout, save, load, ps, kill, top, pkg, ping, ifconfig, curl, mount, umount, chmod, chown, sudo")
+        output.append("Available: help, clear, exit, ls, cd, mkdir, touch, rm, cat, whoami, logout, save, load, ps, kill, top, pkg, ping, ifconfig, curl, mount, umount, chmod, chown, sudo, history, snapshot, import, export, sha256sum, md5sum, fsck")
     elif c == "clear":
         win.buffer = []
     elif c == "exit":
         output.append("Use Ctrl+C to quit TerminalOS.")
     elif c == "ls":
-        items = win.cwd.list()
-        if not items:
-            output.append("")
+        flags = set()
+        page = None
+        operands = []
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a.startswith("--page"):
+                value = a.partition("=")[2] if "=" in a else (args[i+1] if i + 1 < len(args) else "")
+                i += 1 if "=" in a else 2
+                if not value.isdigit() or int(value) < 1:
+                    return CommandOutput([f"ls: invalid page number: '{value}'"], 1)
+                page = int(value)
+                continue
+            if a.startswith("-") and len(a) > 1:
+                if not set(a[1:]) <= set("laSt"):
+                    return CommandOutput([f"ls: invalid option -- '{a}'"], 1)
+                flags.update(a[1:])
+            else:
+                operands.append(a)
+            i += 1
+        if len(operands) > 1:
+            return CommandOutput(["Usage: ls [-laSt] [--page N] [dir]"], 1)
+        target = operands[0] if operands else "."
+        loc = locate(win, target)
+        obj = lookup(loc) if loc is not None else None
+        if obj is None:
+            output.fail(f"ls: cannot access '{target}': No such file or directory")
+        elif not isinstance(obj, Directory):
+            if not can_access(win, loc, ""):
+                output.fail(f"ls: cannot access '{target}': Permission denied")
+            else:
+                output.append(format_entry(target, obj, "l" in flags))
+        elif not can_access(win, loc, "r"):
+            output.fail(f"ls: cannot open directory '{target}': Permission denied")
         else:
-            # Show type and permissions
-            def permstr(obj):
-                if isinstance(obj, Directory):
-                    t = 'd'
-                elif isinstance(obj, Symlink):
-                    t = 'l'
-                elif isinstance(obj, Hardlink):
-                    t = 'h'
-                else:
-                    t = '-'
-                m = obj.mode if hasattr(obj, 'mode') else 0o777
-                perms = ''.join([('r' if m & (1<<8-i*3) else '-') + ('w' if m & (1<<7-i*3) else '-') + ('x' if m & (1<<6-i*3) else '-') for i in range(3)])
-                return t + perms
-            lines = []
-            for k in sorted(items):
-                obj = win.cwd.contents[k]
-                pstr = permstr(obj)
-                if isinstance(obj, Symlink):
-                    lines.append(f"{pstr} {obj.owner:8} {k} -> {obj.target}")
-                else:
-                    lines.append(f"{pstr} {obj.owner:8} {k}")
+            lines, footer = list_directory(obj, flags, page, lookup(loc[:-1]))
             output.extend(lines)
+            if footer:
+                output.footer.append(footer)
     elif c == "cd":
         if not args:
             return []
@@ -568,53 +1970,105 @@ def handle_command(cmd, win):
                 win.path.pop()
                 win.cwd = win.path[-1]
         elif args[0] in win.cwd.contents and isinstance(win.cwd.contents[args[0]], Directory):
+            if not can_access(win, cwd_names(win) + [args[0]], "x"):
+                return CommandOutput([f"cd: permission denied: {args[0]}"], 1)
             win.cwd = win.cwd.contents[args[0]]
             win.path.append(win.cwd)
         else:
-            output.append(f"cd: no such directory: {args[0]}")
+            output.fail(f"cd: no such directory: {args[0]}")
     elif c == "mkdir":
         if not args:
-            output.append("mkdir: missing operand")
+            output.fail("mkdir: missing operand")
+        elif not valid_name(args[0]):
+            output.fail(f"mkdir: cannot create directory '{args[0]}': Invalid name")
         elif args[0] in win.cwd.contents:
-            output.append(f"mkdir: cannot create directory '{args[0]}': File exists")
+            output.fail(f"mkdir: cannot create directory '{args[0]}': File exists")
+        elif not can_access(win, cwd_names(win), "wx"):
+            output.fail(f"mkdir: cannot create directory '{args[0]}': Permission denied")
         else:
             d = Directory(args[0], win.current_user if win.current_user else "guest")
-            win.cwd.add(d)
+            writable_dir(cwd_names(win)).add(d)
     elif c == "touch":
         if not args:
-            output.append("touch: missing file operand")
+            output.fail("touch: missing file operand")
+        elif not valid_name(args[0]):
+            output.fail(f"touch: cannot touch '{args[0]}': Invalid name")
         elif args[0] in win.cwd.contents:
-            obj = win.cwd.contents[args[0]]
-            if isinstance(obj, File):
-                obj.size = len(obj.content)
+            loc = locate(win, args[0])
+            if loc is None:
+                output.fail(f"touch: cannot touch '{args[0]}': No such file or directory")
+            elif not can_access(win, loc, "w"):
+                output.fail(f"touch: cannot touch '{args[0]}': Permission denied")
+            else:
+                writable_obj(loc).mtime = time.time()
+        elif not can_access(win, cwd_names(win), "wx"):
+            output.fail(f"touch: cannot touch '{args[0]}': Permission denied")
         else:
             f = File(args[0], "", win.current_user if win.current_user else "guest")
-            win.cwd.add(f)
+            writable_dir(cwd_names(win)).add(f)
+    elif c == "rm":
+        if not args:
+            output.fail("rm: missing operand")
+        for a in args:
+            names = split_path(win, a)
+            obj = lookup(names)
+            if obj is None:
+                output.fail(f"rm: cannot remove '{a}': No such file or directory")
+            elif isinstance(obj, Directory):
+                output.fail(f"rm: cannot remove '{a}': Is a directory")
+            elif not can_access(win, names[:-1], "wx"):
+                output.fail(f"rm: cannot remove '{a}': Permission denied")
+            else:
+                d = writable_dir(names[:-1])
+                links = [k for k, v in d.contents.items() if isinstance(v, Hardlink) and v.target_file is obj]
+                if links:
+                    # The first hardlink takes over the file, the rest follow it
+                    survivor = obj.clone()
+                    survivor.name = links[0]
+                    d.contents[links[0]] = survivor
+                    for k in links[1:]:
+                        v = d.contents[k]
+                        d.contents[k] = Hardlink(k, survivor, v.owner, v.mode)
+                d.remove(names[-1])
     elif c == "cat":
         if not args:
-            output.append("cat: missing file operand")
+            output.fail("cat: missing file operand")
         elif args[0] in win.cwd.contents:
-            obj = resolve_obj(win.cwd.contents[args[0]], win.cwd)
-            if isinstance(obj, File):
+            loc = locate(win, args[0])
+            obj = lookup(loc) if loc is not None else None
+            if obj is not None and not can_access(win, loc, "r"):
+                output.fail(f"cat: {args[0]}: Permission denied")
+            elif isinstance(obj, File):
                 output.extend(obj.content.splitlines() or [""])
             else:
-                output.append(f"cat: {args[0]}: Not a file")
+                output.fail(f"cat: {args[0]}: Not a file")
         else:
-            output.append(f"cat: {args[0]}: No such file")
+            output.fail(f"cat: {args[0]}: No such file")
     elif c == "whoami":
         output.append(win.current_user)
+    elif c == "history":
+        entries = history_store.get(win.current_user)
+        try:
+            n = int(args[0]) if args else 20
+        except ValueError:
+            return CommandOutput([f"history: {args[0]}: numeric argument required"], 1)
+        start = max(len(entries) - n, 0)
+        for i in range(start, len(entries)):
+            output.append(f"{i+1:5}  {entries[i]}")
     elif c == "logout":
         win.logged_in = False
         win.current_user = None
         win.login_state = "username"
         output.append("Logged out. Username:")
+    elif c in ("save", "load") and not is_privileged(win):
+        output.fail(f"{c}: Permission denied (try sudo)")
     elif c == "save":
         try:
             save_filesystem(root)
             save_users(users)
             output.append("System state saved.")
         except Exception as e:
-            output.append(f"Save failed: {e}")
+            output.fail(f"Save failed: {e}")
     elif c == "load":
         try:
             r = load_filesystem()
@@ -630,7 +2084,7 @@ def handle_command(cmd, win):
                 users.update(u)
                 output.append("User data loaded.")
         except Exception as e:
-            output.append(f"Load failed: {e}")
+            output.fail(f"Load failed: {e}")
     elif c == "ps":
         procs = procman.get_list()
         output.append("  PID USER     CPU  MEM COMMAND")
@@ -638,16 +2092,16 @@ def handle_command(cmd, win):
             output.append(f"{p.pid:5} {p.owner:8} {p.cpu:4.1f} {p.mem:4.1f} {p.name}")
     elif c == "kill":
         if not args:
-            output.append("kill: missing process ID")
+            output.fail("kill: missing process ID")
         else:
             try:
                 pid = int(args[0])
                 if procman.kill(pid):
                     output.append(f"Process {pid} killed")
                 else:
-                    output.append(f"kill: ({pid}) - No such process")
+                    output.fail(f"kill: ({pid}) - No such process")
             except Exception:
-                output.append("kill: invalid process ID")
+                output.fail("kill: invalid process ID")
     elif c == "top":
         procs = procman.get_list()
         output.append("  PID USER     CPU  MEM COMMAND")
@@ -655,16 +2109,16 @@ def handle_command(cmd, win):
             output.append(f"{p.pid:5} {p.owner:8} {p.cpu:4.1f} {p.mem:4.1f} {p.name}")
     elif c == "pkg":
         if not args:
-            output.append("Usage: pkg [install|list|available] [package]")
+            output.fail("Usage: pkg [install|list|available] [package]")
         elif args[0] == "install":
             if len(args) > 1:
                 ok, ver = pkgman.install(args[1])
                 if ok:
                     output.append(f"Installed {args[1]} {ver}")
                 else:
-                    output.append(f"pkg: package '{args[1]}' not found")
+                    output.fail(f"pkg: package '{args[1]}' not found")
             else:
-                output.append("pkg install: missing package name")
+                output.fail("pkg install: missing package name")
         elif args[0] == "list":
             inst = pkgman.list_installed()
             output.append("Installed packages:")
@@ -678,9 +2132,9 @@ def handle_command(cmd, win):
                     output.append(f"  {k} {v}")
     elif c == "ping":
         if not args:
-            output.append("ping: missing destination")
+            output.fail("ping: missing destination")
         elif not network_up:
-            output.append(f"ping: {args[0]}: Network is unreachable")
+            output.fail(f"ping: {args[0]}: Network is unreachable")
         else:
             target = args[0]
             output.append(f"PING {target} (192.168.1.{random.randint(1,254)}) 56(84) bytes of data.")
@@ -700,9 +2154,9 @@ def handle_command(cmd, win):
             output.append("Network interface down")
     elif c == "curl":
         if not args:
-            output.append("curl: missing URL")
+            output.fail("curl: missing URL")
         elif not network_up:
-            output.append("curl: Network is unreachable")
+            output.fail("curl: Network is unreachable")
         else:
             url = args[0]
             output.append(f"Connecting to {url}...")
@@ -721,22 +2175,26 @@ def handle_command(cmd, win):
             if success:
                 output.append(f"Mounted {device} at {mount_point}")
             else:
-                output.append(f"mount: cannot mount {device}")
+                output.fail(f"mount: cannot mount {device}")
     elif c == "umount":
         if not args:
-            output.append("umount: missing device")
+            output.fail("umount: missing device")
         else:
             device = args[0]
             if mountman.unmount_device(device):
                 output.append(f"Unmounted {device}")
             else:
-                output.append(f"umount: {device} not mounted")
+                output.fail(f"umount: {device} not mounted")
     elif c == "chmod":
         if len(args) >= 2:
             mode = args[0]
             filename = args[1]
-            if filename in win.cwd.contents:
-                obj = resolve_obj(win.cwd.contents[filename], win.cwd)
+            loc = locate(win, filename) if filename in win.cwd.contents else None
+            target = lookup(loc) if loc is not None else None
+            if target is not None and not (can_access(win, loc, "") and (is_privileged(win) or target.owner == win.current_user)):
+                output.fail(f"chmod: changing permissions of '{filename}': Operation not permitted")
+            elif target is not None:
+                obj = writable_obj(loc)
                 try:
                     if re.match(r"^[0-7]{3,4}$", mode):
                         obj.mode = int(mode, 8)
@@ -744,23 +2202,26 @@ def handle_command(cmd, win):
                         obj.mode = parse_symbolic_chmod(mode, getattr(obj, 'mode', 0o644))
                     output.append(f"Changed permissions of '{filename}' to {oct(obj.mode)[2:]}")
                 except Exception:
-                    output.append(f"chmod: invalid mode: {mode}")
+                    output.fail(f"chmod: invalid mode: {mode}")
             else:
-                output.append(f"chmod: cannot access '{filename}': No such file or directory")
+                output.fail(f"chmod: cannot access '{filename}': No such file or directory")
         else:
-            output.append("chmod: missing operand")
+            output.fail("chmod: missing operand")
     elif c == "chown":
         if len(args) >= 2:
             owner = args[0]
             filename = args[1]
-            if filename in win.cwd.contents:
-                obj = resolve_obj(win.cwd.contents[filename], win.cwd)
+            loc = locate(win, filename) if filename in win.cwd.contents else None
+            if loc is not None and not is_privileged(win):
+                output.fail(f"chown: changing ownership of '{filename}': Operation not permitted")
+            elif loc is not None and lookup(loc) is not None:
+                obj = writable_obj(loc)
                 obj.owner = owner
                 output.append(f"Changed ownership of '{filename}' to {owner}")
             else:
-                output.append(f"chown: cannot access '{filename}': No such file or directory")
+                output.fail(f"chown: cannot access '{filename}': No such file or directory")
         else:
-            output.append("chown: missing operand")
+            output.fail("chown: missing operand")
     elif c == "df":
         # Show disk usage for each mount (simulate only root and home for now)
         mounts = [("/", root), ("/home", root.get("home"))]
@@ -774,45 +2235,172 @@ def handle_command(cmd, win):
                 output.append(f"fakefs      {size//1024}K   {used//1024}K   {avail//1024}K   {usep}%   {mnt}")
     elif c == "du":
         # Show disk usage for current dir or given dir
+        allow = access_checker(win)
         def du_dir(d, path, seen=None):
             if seen is None:
                 seen = set()
             size = d.get_size(seen)
-            lines = [f"{size} {path}"]
+            output.append(f"{size} {path}")
             for obj in d.contents.values():
-                if isinstance(obj, Directory):
-                    lines += du_dir(obj, os.path.join(path, obj.name), seen)
-            return lines
+                if not isinstance(obj, Directory):
+                    continue
+                sub = os.path.join(path, obj.name)
+                if allow and not allow(obj, "rx"):
+                    output.fail(f"du: cannot read directory '{sub}': Permission denied")
+                else:
+                    du_dir(obj, sub, seen)
         target = win.cwd
         path = "/" + "/".join(d.name for d in win.path[1:])
+        names = cwd_names(win)
         if args and args[0] in win.cwd.contents and isinstance(win.cwd.contents[args[0]], Directory):
             target = win.cwd.contents[args[0]]
             path = os.path.join(path, args[0])
-        output += du_dir(target, path)
+            names = names + [args[0]]
+        if not can_access(win, names, "rx"):
+            output.fail(f"du: cannot read directory '{path}': Permission denied")
+        else:
+            du_dir(target, path)
     elif c == "ln":
         if not args or len(args) < 2:
-            output.append("Usage: ln [-s] target linkname")
+            output.fail("Usage: ln [-s] target linkname")
+        elif not can_access(win, cwd_names(win), "wx"):
+            output.fail(f"ln: failed to create link '{args[-1]}': Permission denied")
         elif args[0] == "-s":
             # Symlink
             if len(args) < 3:
-                output.append("Usage: ln -s target linkname")
+                output.fail("Usage: ln -s target linkname")
             else:
                 target, linkname = args[1], args[2]
-                if linkname in win.cwd.contents:
-                    output.append(f"ln: failed to create symlink '{linkname}': File exists")
+                if not valid_name(linkname):
+                    output.fail(f"ln: failed to create symlink '{linkname}': Invalid name")
+                elif linkname in win.cwd.contents:
+                    output.fail(f"ln: failed to create symlink '{linkname}': File exists")
                 else:
-                    win.cwd.add(Symlink(linkname, target, win.current_user))
+                    writable_dir(cwd_names(win)).add(Symlink(linkname, target, win.current_user))
         else:
             # Hardlink
             target, linkname = args[0], args[1]
-            if linkname in win.cwd.contents:
-                output.append(f"ln: failed to create hard link '{linkname}': File exists")
+            if not valid_name(linkname):
+                output.fail(f"ln: failed to create hard link '{linkname}': Invalid name")
+            elif linkname in win.cwd.contents:
+                output.fail(f"ln: failed to create hard link '{linkname}': File exists")
             elif target not in win.cwd.contents or not isinstance(win.cwd.contents[target], File):
-                output.append(f"ln: failed to access '{target}': No such file")
+                output.fail(f"ln: failed to access '{target}': No such file")
+            else:
+                d = writable_dir(cwd_names(win))
+                d.add(Hardlink(linkname, d.contents[target], win.current_user))
+    elif c == "import":
+        map_owners = "--owners" in args
+        args = [a for a in args if a != "--owners"]
+        if len(args) < 2:
+            output.fail("Usage: import [--owners] hostdir vfsdir")
+        elif not os.path.isdir(os.path.expanduser(args[0])):
+            output.fail(f"import: {args[0]}: No such host directory")
+        else:
+            names = split_path(win, args[1])
+            for i in range(len(names)):
+                existing = lookup(names[:i+1])
+                if existing is None:
+                    if not can_access(win, names[:i], "wx"):
+                        return CommandOutput([f"import: {args[1]}: Permission denied"], 1)
+                    writable_dir(names[:i]).add(Directory(names[i], win.current_user or "guest"))
+                elif not isinstance(existing, Directory):
+                    return CommandOutput([f"import: {args[1]}: Not a directory"], 1)
+            if not can_access(win, names, "wx"):
+                return CommandOutput([f"import: {args[1]}: Permission denied"], 1)
+            start = time.time()
+            stats = import_tree(os.path.expanduser(args[0]), writable_dir(names), win.current_user or "guest", map_owners)
+            output.extend(transfer_report("Imported", stats, time.time() - start))
+    elif c == "export":
+        if len(args) < 2:
+            output.fail("Usage: export vfsdir hostdir")
+        else:
+            names = split_path(win, args[0])
+            source = lookup(names)
+            if not isinstance(source, Directory):
+                output.fail(f"export: {args[0]}: No such directory")
+            elif not can_access(win, names, "rx"):
+                output.fail(f"export: {args[0]}: Permission denied")
+            else:
+                start = time.time()
+                stats = export_tree(source, os.path.expanduser(args[1]), access_checker(win))
+                output.extend(transfer_report("Exported", stats, time.time() - start))
+    elif c in ("sha256sum", "md5sum"):
+        algo = "sha256" if c == "sha256sum" else "md5"
+        recursive = "-r" in args
+        paths = [a for a in args if a != "-r"]
+        if not paths:
+            output.fail(f"{c}: missing file operand")
+        files = []  # (path, File) or (path, error), in argument order
+        for path in paths:
+            loc = locate(win, path)
+            obj = lookup(loc) if loc is not None else None
+            if obj is not None and not can_access(win, loc, "rx" if isinstance(obj, Directory) else "r"):
+                files.append((path, "Permission denied"))
+            elif isinstance(obj, File):
+                files.append((path, obj))
+            elif isinstance(obj, Directory):
+                if recursive:
+                    collect_files(obj, path, files, access_checker(win))
+                else:
+                    files.append((path, "Is a directory"))
+            else:
+                files.append((path, "No such file or directory"))
+        hash_files([f for _, f in files if isinstance(f, File)], algo)
+        for path, f in files:
+            if isinstance(f, File):
+                output.append(f"{f.digests[algo]}  {path}")
+            else:
+                output.fail(f"{c}: {path}: {f}")
+    elif c == "fsck" and not is_privileged(win):
+        output.fail("fsck: Permission denied (try sudo)")
+    elif c == "fsck":
+        problems = []
+        checked = fsck_tree(root, [], problems)
+        output.extend(problems)
+        output.append(f"fsck: {checked} entries checked, {len(problems)} problem{'s' if len(problems) != 1 else ''} found")
+        output.status = 1 if problems else 0
+    elif c == "snapshot":
+        if not args:
+            output.fail("Usage: snapshot [create|list|diff|rollback] [name]")
+        elif args[0] in ("create", "rollback") and not is_privileged(win):
+            output.fail(f"snapshot {args[0]}: Permission denied (try sudo)")
+        elif args[0] == "create":
+            if len(args) < 2:
+                output.fail("snapshot create: missing snapshot name")
+            elif snapman.create(args[1], root):
+                output.append(f"Snapshot '{args[1]}' created")
+            else:
+                output.fail(f"snapshot: '{args[1]}' already exists")
+        elif args[0] == "list":
+            for name, snap in snapman.list():
+                output.append(f"{name:16} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snap['time']))}")
+        elif args[0] == "diff":
+            if len(args) < 2:
+                output.fail("Usage: snapshot diff name [name]")
             else:
-                win.cwd.add(Hardlink(linkname, win.cwd.contents[target], win.current_user))
+                a = snapman.get(args[1])
+                b = snapman.get(args[2]) if len(args) > 2 else root
+                if a is None or b is None:
+                    missing = args[1] if a is None else args[2]
+                    output.fail(f"snapshot: '{missing}' not found")
+                else:
+                    output.extend(diff_trees(a, b, allow=access_checker(win)))
+        elif args[0] == "rollback":
+            r = snapman.get(args[1]) if len(args) > 1 else None
+            if r is None:
+                output.fail(f"snapshot: '{args[1] if len(args) > 1 else ''}' not found")
+            else:
+                # The restored tree stays shared with the snapshot, so freeze it again
+                root = r
+                home = root.get("home")
+                fs_epoch += 1
+                rebind_windows()
+                output.append(f"Rolled back to snapshot '{args[1]}'")
+        else:
+            output.fail(f"snapshot: unknown subcommand '{args[0]}'")
     else:
-        output.append(f"Unknown command: {cmd}")
+        output.fail(f"Unknown command: {cmd}")
     return output
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Importing main loads filesystem.tos, users.tos and history.tos from the
+# working directory, so do it from an empty one
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+pristine_root = main.root
+pristine_users = {name: dict(u) for name, u in main.users.items()}
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    # Every test starts from the default tree; bumping the epoch freezes it,
+    # so writes copy nodes instead of touching the shared original
+    main.root = pristine_root
+    main.home = pristine_root.get("home")
+    main.fs_epoch += 1
+    main.users.clear()
+    main.users.update({name: dict(u) for name, u in pristine_users.items()})
+    main.snapman = main.SnapshotManager()
+    main.windows[:] = []
+    yield
+
+def login(user):
+    win = main.TerminalWindow(len(main.windows))
+    win.current_user = user
+    win.logged_in = True
+    win.path = [main.root, main.root.get("home"), main.root.get("home").get(user)]
+    win.cwd = win.path[-1]
+    main.windows.append(win)
+    return win
+
+def run(win, script):
+    return list(main.handle_command(script, win)), win.last_status
+
+@pytest.fixture
+def guest():
+    return login("guest")
+
+@pytest.fixture
+def admin():
+    return login("admin")
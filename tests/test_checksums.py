@@ -0,0 +1,79 @@
+import hashlib
+
+import main
+from conftest import run
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def test_fsck_success_exits_zero(admin):
+    out, status = run(admin, "fsck && echo ok")
+    assert out[-1] == "ok"
+    assert status == 0
+
+def test_fsck_follows_relative_symlinks(admin):
+    run(admin, "mkdir sub; echo x > f; cd sub; ln -s ../f up; cd ..; ln -s sub/up chain; ln -s /home/admin/f abs")
+    assert run(admin, "cat chain")[0] == ["x"]
+    out, status = run(admin, "fsck")
+    assert len(out) == 1 and out[0].endswith(" 0 problems found")
+    assert status == 0
+
+def test_fsck_reports_dangling_links_and_loops(admin):
+    run(admin, "ln -s ../nowhere dang; ln -s b a; ln -s a b")
+    out, status = run(admin, "fsck")
+    assert out[:-1] == [
+        "/home/admin/dang: dangling symlink -> ../nowhere",
+        "/home/admin/a: symlink loop -> b",
+        "/home/admin/b: symlink loop -> a",
+    ]
+    assert status == 1
+
+def count_hashed(monkeypatch):
+    hashed = []
+    real = main.hash_batch
+    def counting(algo, contents):
+        hashed.extend(contents)
+        return real(algo, contents)
+    monkeypatch.setattr(main, "hash_batch", counting)
+    return hashed
+
+def test_sha256sum_matches_hashlib(admin):
+    run(admin, "mkdir d; echo one > d/a; echo two > d/b")
+    out, status = run(admin, "sha256sum -r d")
+    assert out == [
+        sha256("one\n") + "  d/a",
+        sha256("two\n") + "  d/b",
+    ]
+    assert status == 0
+
+def test_second_run_hashes_nothing(admin, monkeypatch):
+    run(admin, "mkdir d; echo one > d/a; echo two > d/b")
+    hashed = count_hashed(monkeypatch)
+    first = run(admin, "sha256sum -r d")
+    assert sorted(hashed) == ["one\n", "two\n"]
+    hashed.clear()
+    assert run(admin, "sha256sum -r d") == first
+    assert hashed == []
+
+def test_write_drops_the_cached_digest(admin, monkeypatch):
+    run(admin, "mkdir d; echo one > d/a; echo two > d/b; sha256sum -r d")
+    hashed = count_hashed(monkeypatch)
+    run(admin, "echo more >> d/a")
+    out, _ = run(admin, "sha256sum -r d")
+    assert hashed == ["one\nmore\n"]
+    assert out[0] == sha256("one\nmore\n") + "  d/a"
+
+def test_snapshot_copy_keeps_its_digest(admin, monkeypatch):
+    run(admin, "echo one > f; sha256sum f; snapshot create s0; echo two > g")
+    hashed = count_hashed(monkeypatch)
+    run(admin, "sha256sum f")
+    assert hashed == []
+
+def test_large_jobs_use_the_process_pool(admin, monkeypatch):
+    monkeypatch.setattr(main, "HASH_PARALLEL_BYTES", 1)
+    monkeypatch.setattr(main, "HASH_BATCH_BYTES", 4)
+    files = [main.File(f"f{i}", f"content {i}") for i in range(6)]
+    assert main.hash_files(files, "md5") == 6
+    assert [f.digests["md5"] for f in files] == [hashlib.md5(f.content.encode()).hexdigest() for f in files]
+    assert main.hash_files(files, "md5") == 0
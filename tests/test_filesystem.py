@@ -0,0 +1,73 @@
+import main
+from conftest import run
+
+
+def fill(d, names):
+    for n in names:
+        d.add(main.File(n, n))
+
+def test_hidden_entries_are_skipped_across_pages(monkeypatch):
+    monkeypatch.setattr(main, "LS_PAGE_SIZE", 3)
+    d = main.Directory("d")
+    fill(d, ["a", "b", ".x", ".y", "c", "d", "e"])
+    assert main.list_directory(d, set(), 1)[0] == ["a", "b", "c"]
+    assert main.list_directory(d, set(), 2) == (["d", "e"], "-- page 2/2 (5 entries), ls --page N for more --")
+    assert main.list_directory(d, {"a"}, 1)[0] == [".", "..", ".x", ".y", "a"]
+    assert main.list_directory(d, set()) == (["a", "b", "c", "d", "e"], None)
+
+def test_names_sorting_before_dotfiles_stay_visible():
+    d = main.Directory("d")
+    fill(d, ["-n", ".h", "+p", "z"])
+    assert main.list_directory(d, set())[0] == ["+p", "-n", "z"]
+
+def test_sorted_index_after_remove():
+    d = main.Directory("d")
+    fill(d, ["b", "a"])
+    d.sorted_names()
+    fill(d, ["c"])
+    d.remove("a")
+    d.remove("c")
+    d.remove("missing")
+    assert d.sorted_names() == ["b"]
+    assert list(d.contents) == ["b"]
+
+def test_ls_directory_operand(admin):
+    run(admin, "mkdir sub; echo x > sub/f; ln -s sub link")
+    assert run(admin, "ls sub") == (["f"], 0)
+    assert run(admin, "ls link") == (["f"], 0)
+    assert run(admin, "ls sub/f") == (["sub/f"], 0)
+    assert run(admin, "ls nope") == (["ls: cannot access 'nope': No such file or directory"], 1)
+    assert run(admin, "ls a b")[1] == 1
+
+def test_ls_dotdot_shows_parent(admin):
+    run(admin, "mkdir sub; chmod 700 sub")
+    out, _ = run(admin, "ls -la sub")
+    assert out[0].startswith("drwx------") and out[0].endswith(" .")
+    assert out[1].startswith("drwxr-xr-x") and out[1].endswith(" ..")
+
+def test_touch_updates_mtime(admin):
+    run(admin, "echo x > f")
+    f = admin.cwd.get("f")
+    f.mtime = 0
+    assert run(admin, "touch f") == ([], 0)
+    assert admin.cwd.get("f").mtime > 0
+    assert admin.cwd.get("f").content == "x\n"
+
+def test_rm_keeps_hardlinked_content(admin):
+    run(admin, "echo x > f; ln f h1; ln f h2; rm f")
+    assert run(admin, "cat h1; cat h2") == (["x", "x"], 0)
+    run(admin, "echo y >> h2")
+    assert run(admin, "cat h1")[0] == ["x", "y"]
+    assert run(admin, "fsck")[1] == 0
+
+def test_rm_refuses_directories(admin):
+    run(admin, "mkdir sub")
+    assert run(admin, "rm sub") == (["rm: cannot remove 'sub': Is a directory"], 1)
+
+def test_big_directories_are_paged_only_on_request(admin, monkeypatch):
+    monkeypatch.setattr(main, "LS_PAGE_SIZE", 2)
+    run(admin, "mkdir big; cd big; touch a; touch b; touch c")
+    assert run(admin, "ls") == (["a", "b", "c"], 0)
+    assert run(admin, "ls --page 2") == (["c", "-- page 2/2 (3 entries), ls --page N for more --"], 0)
+    run(admin, "ls --page 1 > ../out.txt; cd ..")
+    assert run(admin, "cat out.txt")[0] == ["a", "b"]
@@ -0,0 +1,66 @@
+import json
+import random
+
+import main
+from conftest import login, run
+
+
+def brute_search(entries, query, before=None):
+    if before is None or before > len(entries):
+        before = len(entries)
+    for pos in range(before - 1, -1, -1):
+        if query in entries[pos]:
+            return pos
+    return -1
+
+def random_commands(rng, n):
+    words = ["ls", "cat", "echo", "grep", "make", "git", "push", "pull", "build", "test"]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(n)]
+
+def test_search_matches_a_full_scan(tmp_path):
+    rng = random.Random(7)
+    store = main.HistoryStore(str(tmp_path / "h.tos"), max_entries=200)
+    for cmd in random_commands(rng, 1000):
+        store.add("guest", cmd)
+    entries = store.get("guest")
+    # Trimmed in chunks, so the index has been rebuilt along the way
+    assert 200 <= len(entries) <= 220
+    for _ in range(500):
+        cmd = rng.choice(entries)
+        start = rng.randint(0, len(cmd))
+        query = cmd[start:start + rng.randint(1, 6)]
+        before = rng.choice([None, rng.randint(0, len(entries) + 5)])
+        assert store.search("guest", query, before) == brute_search(entries, query, before)
+    assert store.search("guest", "no such command") == -1
+    assert store.search("admin", "ls") == -1
+
+def test_history_survives_a_reload(tmp_path):
+    path = str(tmp_path / "h.tos")
+    store = main.HistoryStore(path)
+    store.add("guest", "echo one")
+    store.add("admin", "fsck")
+    store.add("guest", "echo two")
+    with open(path, "a") as f:
+        f.write("not json\n")
+    again = main.HistoryStore(path)
+    assert again.get("guest") == ["echo one", "echo two"]
+    assert again.get("admin") == ["fsck"]
+    assert again.search("guest", "one") == 0
+
+def test_load_compacts_a_long_log(tmp_path):
+    path = tmp_path / "h.tos"
+    with open(path, "w") as f:
+        for i in range(50):
+            f.write(json.dumps({"user": "guest", "cmd": f"echo {i}"}) + "\n")
+    store = main.HistoryStore(str(path), max_entries=10)
+    kept = store.get("guest")
+    assert kept[-1] == "echo 49" and len(kept) <= 11
+    assert len(path.read_text().splitlines()) == len(kept)
+    assert main.HistoryStore(str(path), max_entries=10).get("guest") == kept
+
+def test_windows_share_one_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "history_store", main.HistoryStore(str(tmp_path / "h.tos")))
+    first, second, other = login("guest"), login("guest"), login("admin")
+    main.history_store.add(first.current_user, "echo from first")
+    assert run(second, "history")[0] == ["    1  echo from first"]
+    assert run(other, "history")[0] == []
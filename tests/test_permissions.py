@@ -0,0 +1,57 @@
+import main
+from conftest import run
+
+
+def make_private(admin):
+    run(admin, "mkdir priv; echo secret > priv/s; echo open > pub; chmod 700 priv")
+
+def test_other_users_cannot_write(guest):
+    out, status = run(guest, "echo x > /etc/motd")
+    assert out == ["sh: /etc/motd: Permission denied"]
+    assert status == 1
+    assert main.root.get("etc").get("motd") is None
+
+def test_private_directory_hides_its_contents(admin, guest):
+    make_private(admin)
+    assert run(guest, "cd ..; cd admin; cat pub")[0] == ["open"]
+    assert run(guest, "cd priv") == (["cd: permission denied: priv"], 1)
+    assert run(guest, "ls /home/admin/priv") == (["ls: cannot open directory '/home/admin/priv': Permission denied"], 1)
+    assert run(guest, "[ -e /home/admin/priv/s ] && echo yes || echo no")[0] == ["no"]
+    assert run(admin, "[ -f priv/s ] && echo yes")[0] == ["yes"]
+
+def test_symlink_does_not_bypass_permissions(admin, guest):
+    make_private(admin)
+    run(guest, "ln -s /home/admin/priv/s peek")
+    assert run(guest, "cat peek") == (["cat: peek: Permission denied"], 1)
+
+def test_chmod_takes_effect_immediately(admin, guest):
+    run(admin, "echo hi > f")
+    assert run(guest, "cd ..; cd admin; cat f")[0] == ["hi"]
+    run(admin, "chmod 600 f")
+    assert run(guest, "cat f") == (["cat: f: Permission denied"], 1)
+
+def test_rm_needs_write_on_the_directory(admin, guest):
+    run(admin, "echo hi > f")
+    assert run(guest, "rm /home/admin/f") == (["rm: cannot remove '/home/admin/f': Permission denied"], 1)
+    assert run(admin, "rm f") == ([], 0)
+
+def test_snapshot_diff_is_filtered(admin, guest):
+    run(admin, "mkdir priv; snapshot create s0")
+    run(admin, "echo secret > priv/s; echo open > pub; chmod 700 priv")
+    assert run(guest, "snapshot diff s0")[0] == ["A /home/admin/pub"]
+    assert run(admin, "snapshot diff s0")[0] == ["M /home/admin/priv", "A /home/admin/priv/s", "A /home/admin/pub"]
+
+def test_privileged_commands(guest):
+    for cmd in ("save", "load", "snapshot create s0", "snapshot rollback s0", "fsck"):
+        assert run(guest, cmd)[1] == 1, cmd
+    assert run(guest, "sudo fsck") == (["sudo: user not in sudoers file"], 1)
+
+def test_du_skips_unreadable_directories(admin, guest):
+    run(admin, "mkdir priv; cd priv; mkdir secret-project; cd ..; chmod 700 priv")
+    out, status = run(guest, "cd ..; du")
+    assert not any("secret-project" in line for line in out)
+    assert "du: cannot read directory '/home/admin/priv': Permission denied" in out
+    assert status == 1
+    out, status = run(admin, "cd ..; du")
+    assert any(line.endswith("/home/admin/priv/secret-project") for line in out)
+    assert status == 0
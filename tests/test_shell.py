@@ -0,0 +1,83 @@
+import main
+from conftest import run
+
+
+def test_variables_and_arithmetic(guest):
+    assert run(guest, "x=3; echo $((x * 2 + 1)) ${x}y") == (["7 3y"], 0)
+
+def test_arithmetic_division_truncates_toward_zero(guest):
+    assert run(guest, "echo $((-7 / 2)) $((-7 % 2))")[0] == ["-3 -1"]
+
+def test_for_loop_appends_to_file(guest):
+    out, status = run(guest, 'for i in 1 2 3; do echo "item $i" >> list.txt; done; cat list.txt')
+    assert out == ["item 1", "item 2", "item 3"]
+    assert status == 0
+
+def test_while_loop_with_break(guest):
+    out, _ = run(guest, "i=0; while true; do i=$((i + 1)); if [ $i -ge 4 ]; then break; fi; done; echo $i")
+    assert out == ["4"]
+
+def test_and_or_use_exit_status(guest):
+    out, _ = run(guest, "cat missing && echo yes || echo no")
+    assert out == ["cat: missing: No such file", "no"]
+
+def test_status_does_not_depend_on_output_text(guest):
+    out, status = run(guest, 'echo "cat: not an error" > f; cat f && echo ok')
+    assert out == ["cat: not an error", "ok"]
+    assert status == 0
+
+def test_functions_and_return(guest):
+    out, _ = run(guest, "add() { echo $(($1 + $2)); return 3; }; add 2 5; echo $?")
+    assert out == ["7", "3"]
+
+def test_source_passes_arguments(guest):
+    run(guest, "echo 'echo hello $1' > greet.sh")
+    assert run(guest, "source greet.sh world") == (["hello world"], 0)
+
+def test_quoting(guest):
+    out, _ = run(guest, "HOME=/h; echo '$HOME' \"$HOME\" \"\\$HOME\" \"\\\\$HOME\" \\$HOME")
+    assert out == ["$HOME /h $HOME \\/h $HOME"]
+
+def test_empty_quoted_argument_is_kept(guest):
+    assert run(guest, 'x=""; [ -z "$x" ] && echo empty')[0] == ["empty"]
+
+def test_runtime_failures_do_not_stop_the_script(guest):
+    out, status = run(guest, "echo a > /nonexist/x; echo $?; [ a -lt 3 ]; echo $?; source nofile; echo $?")
+    assert out == [
+        "sh: /nonexist/x: No such file or directory", "1",
+        "sh: test: integer expression expected", "2",
+        "sh: source: nofile: No such file", "1",
+    ]
+    assert status == 0
+
+def test_syntax_error_aborts_the_script(guest):
+    out, status = run(guest, "echo before; if true; echo never")
+    assert out == ["sh: syntax error: expected 'then' near 'end of input'"]
+    assert status == 2
+
+def test_loop_limit(guest, monkeypatch):
+    monkeypatch.setattr(main, "SHELL_MAX_LOOPS", 10)
+    out, status = run(guest, "while true; do true; done")
+    assert out == ["sh: loop limit of 10 iterations exceeded"]
+    assert status == 2
+
+def test_script_cache_keeps_recently_used_entries(monkeypatch):
+    monkeypatch.setattr(main, "SCRIPT_CACHE_SIZE", 4)
+    main.script_cache.clear()
+    hot = main.parse_script("echo hot")
+    for i in range(10):
+        main.parse_script(f"echo {i}")
+        assert main.parse_script("echo hot") is hot
+    assert len(main.script_cache) == 4
+
+def test_sudo_runs_builtins_functions_and_commands(admin, guest):
+    assert run(admin, "sudo echo hi") == (["hi"], 0)
+    assert run(admin, "check() { fsck; }; sudo check && echo ok")[0][-1] == "ok"
+    assert run(admin, "sudo false || echo failed") == (["failed"], 0)
+    assert run(admin, "sudo") == (["sudo: missing command"], 1)
+    assert run(guest, "sudo echo hi") == (["sudo: user not in sudoers file"], 1)
+    assert not admin.sudo_mode
+
+def test_export_assignments_and_vfs_export(guest):
+    assert run(guest, "export A=1 B=2; echo $A$B") == (["12"], 0)
+    assert run(guest, "export") == (["Usage: export vfsdir hostdir"], 1)
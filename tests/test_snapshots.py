@@ -0,0 +1,46 @@
+import main
+from conftest import run
+
+
+def test_snapshot_keeps_old_content(admin):
+    run(admin, "echo one > f; snapshot create s0; echo two > f")
+    snap = main.snapman.get("s0")
+    assert snap.get("home").get("admin").get("f").content == "one\n"
+    assert run(admin, "cat f")[0] == ["two"]
+
+def test_untouched_subtrees_stay_shared(admin):
+    run(admin, "snapshot create s0; echo x > f")
+    snap = main.snapman.get("s0")
+    assert snap.get("etc") is main.root.get("etc")
+    assert snap.get("home").get("admin") is not main.root.get("home").get("admin")
+
+def test_diff_reports_added_modified_and_deleted(admin):
+    run(admin, "echo a > keep; echo b > gone; snapshot create s0; echo c > keep; rm gone; touch new")
+    out, status = run(admin, "snapshot diff s0")
+    assert out == ["D /home/admin/gone", "M /home/admin/keep", "A /home/admin/new"]
+    assert status == 0
+
+def test_diff_between_two_snapshots(admin):
+    run(admin, "snapshot create s0; mkdir d; snapshot create s1; echo x > d/f; chmod 700 d")
+    assert run(admin, "snapshot diff s0 s1")[0] == ["A /home/admin/d"]
+    assert run(admin, "snapshot diff s1")[0] == ["M /home/admin/d", "A /home/admin/d/f"]
+
+def test_rollback_restores_tree_and_windows(admin):
+    run(admin, "echo one > f; mkdir d; snapshot create s0; echo two > f; rm f")
+    run(admin, "snapshot rollback s0")
+    assert run(admin, "cat f")[0] == ["one"]
+    assert admin.path[0] is main.root
+    assert admin.cwd is main.root.get("home").get("admin")
+
+def test_rollback_does_not_let_writes_reach_the_snapshot(admin):
+    run(admin, "echo one > f; snapshot create s0; snapshot rollback s0; echo two > f")
+    assert main.snapman.get("s0").get("home").get("admin").get("f").content == "one\n"
+
+def test_hardlinks_follow_the_copied_file(admin):
+    run(admin, "echo one > f; ln f h; snapshot create s0; echo two >> h")
+    assert run(admin, "cat f")[0] == ["one", "two"]
+    assert main.snapman.get("s0").get("home").get("admin").get("f").content == "one\n"
+
+def test_missing_snapshot(admin):
+    assert run(admin, "snapshot diff nope") == (["snapshot: 'nope' not found"], 1)
+    assert run(admin, "snapshot rollback nope") == (["snapshot: 'nope' not found"], 1)
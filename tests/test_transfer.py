@@ -0,0 +1,92 @@
+import os
+import stat
+
+import main
+from conftest import run
+
+
+def make_host_tree(base):
+    src = base / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "plain.txt").write_text("hello\n")
+    (src / "script.sh").write_text("echo hi\n")
+    os.chmod(src / "script.sh", 0o750)
+    (src / "raw.bin").write_bytes(b"\xff\xfe\x00ok")
+    os.link(src / "plain.txt", src / "hard.txt")
+    os.symlink("plain.txt", src / "link")
+    os.symlink("../plain.txt", src / "sub" / "up")
+    os.chmod(src / "sub", 0o700)
+    return src
+
+def test_import_keeps_modes_links_and_bytes(guest, tmp_path):
+    src = make_host_tree(tmp_path)
+    out, status = run(guest, f"import {src} demo")
+    assert status == 0
+    assert out[0].startswith("Imported 3 files, 1 directories, 3 links")
+    demo = guest.cwd.get("demo")
+    assert demo.get("script.sh").mode == 0o750
+    assert demo.get("sub").mode == 0o700
+    assert demo.get("raw.bin").content == b"\xff\xfe\x00ok".decode("utf-8", "surrogateescape")
+    # Whichever name the host lists first becomes the file
+    link, first = sorted((demo.get("hard.txt"), demo.get("plain.txt")), key=lambda o: not isinstance(o, main.Hardlink))
+    assert isinstance(link, main.Hardlink) and link.target_file is first
+    assert demo.get("link").target == "plain.txt"
+    assert run(guest, "cd demo; cd sub; cat up")[0] == ["hello"]
+
+def test_export_round_trip(guest, tmp_path):
+    src = make_host_tree(tmp_path)
+    dest = tmp_path / "dest"
+    run(guest, f"import {src} demo")
+    out, status = run(guest, f"export demo {dest}")
+    assert status == 0
+    assert not any("could not be transferred" in line for line in out)
+    for name in ("plain.txt", "script.sh", "raw.bin", "hard.txt"):
+        assert (dest / name).read_bytes() == (src / name).read_bytes()
+        assert stat.S_IMODE(os.stat(dest / name).st_mode) == stat.S_IMODE(os.stat(src / name).st_mode)
+    assert os.stat(dest / "hard.txt").st_ino == os.stat(dest / "plain.txt").st_ino
+    assert os.readlink(dest / "link") == "plain.txt"
+    assert os.readlink(dest / "sub" / "up") == "../plain.txt"
+    assert stat.S_IMODE(os.stat(dest / "sub").st_mode) == 0o700
+
+def test_cross_directory_hardlinks_become_copies(guest, tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "a").write_text("shared\n")
+    os.link(src / "a", src / "sub" / "b")
+    run(guest, f"import {src} demo")
+    demo = guest.cwd.get("demo")
+    assert isinstance(demo.get("sub").get("b"), main.File)
+    assert demo.get("sub").get("b").content == "shared\n"
+
+def test_unreadable_link_counts_as_an_error(guest, tmp_path, monkeypatch):
+    src = make_host_tree(tmp_path)
+    def fail(path):
+        raise OSError("boom")
+    monkeypatch.setattr(main.os, "readlink", fail)
+    out, status = run(guest, f"import {src} demo")
+    assert out[-1] == "2 entries could not be transferred"
+    assert guest.cwd.get("demo").get("plain.txt") is not None
+    assert guest.cwd.get("demo").get("link") is None
+
+def test_export_skips_invalid_names(admin, tmp_path):
+    run(admin, "mkdir out; echo ok > out/good")
+    out_dir = main.writable_dir(main.cwd_names(admin) + ["out"])
+    out_dir.add(main.File("../escape", "bad"))
+    out, _ = run(admin, f"export out {tmp_path / 'dest'}")
+    assert out[-1] == "1 entries could not be transferred"
+    assert (tmp_path / "dest" / "good").read_text() == "ok\n"
+    assert not (tmp_path / "escape").exists()
+
+def test_invalid_names_are_rejected(admin):
+    for cmd in ("mkdir ..", "touch .", "ln -s f a/b", "echo x > ."):
+        assert run(admin, cmd)[1] == 1, cmd
+
+def test_owners_mapped_only_on_request(guest, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "f").write_text("x")
+    run(guest, f"import {src} plain")
+    assert guest.cwd.get("plain").get("f").owner == "guest"
+    run(guest, f"import --owners {src} mapped")
+    mapped = {u["uid"]: name for name, u in main.users.items()}.get(os.getuid(), "guest")
+    assert guest.cwd.get("mapped").get("f").owner == mapped